@@ -1,10 +1,10 @@
 from __future__ import division, print_function
 
-import os.path, sys, tarfile
+import collections, hashlib, os, os.path, sys, tarfile
+from multiprocessing.pool import ThreadPool
 import numpy as np
 from scipy import linalg
 from six.moves import range, urllib
-from sklearn.metrics.pairwise import polynomial_kernel
 import tensorflow as tf
 from tqdm import tqdm
 
@@ -18,47 +18,59 @@ class TqdmUpTo(tqdm):
 
 
 class Inception(object):
-    def __init__(self):
+    def __init__(self, batch_size=None, config=None):
+        """
+        batch_size: if given, the graph is built for this fixed minibatch size,
+            which featurize then uses; otherwise any size works
+        config: tf.ConfigProto of the model's session
+        """
         MODEL_DIR = '/tmp/imagenet'
         DATA_URL = ('http://download.tensorflow.org/models/image/imagenet/'
                     'inception-2015-12-05.tgz')
         self.softmax_dim = 1008
         self.coder_dim = 2048
+        self.batch_size = batch_size
 
         if not os.path.exists(MODEL_DIR):
             os.makedirs(MODEL_DIR)
         filename = DATA_URL.split('/')[-1]
         filepath = os.path.join(MODEL_DIR, filename)
-
-        if not os.path.exists(filepath):
-            with TqdmUpTo(unit='B', unit_scale=True, miniters=1,
-                          desc=filename) as t:
-                filepath, _ = urllib.request.urlretrieve(
-                    DATA_URL, filepath, reporthook=t.update_to)
-
-        tarfile.open(filepath, 'r:gz').extractall(MODEL_DIR)
-        with tf.gfile.FastGFile(os.path.join(
-                MODEL_DIR, 'classify_image_graph_def.pb'), 'rb') as f:
-            graph_def = tf.GraphDef()
-            graph_def.ParseFromString(f.read())
-            tf.import_graph_def(graph_def, name='')
-
-        # Works with an arbitrary minibatch size.
-        self.sess = sess = tf.Session()
-        #with sess:
-        pool3 = sess.graph.get_tensor_by_name('pool_3:0')
-        ops = pool3.graph.get_operations()
-        for op_idx, op in enumerate(ops):
-            for o in op.outputs:
-                shape = [s.value for s in o.get_shape()]
-                if len(shape) and shape[0] == 1:
-                    shape[0] = None
-                o._shape = tf.TensorShape(shape)
-        w = sess.graph.get_operation_by_name(
-            "softmax/logits/MatMul").inputs[1]
-        self.coder = tf.squeeze(tf.squeeze(pool3, 2), 1)
-        logits = tf.matmul(self.coder, w)
-        self.softmax = tf.nn.softmax(logits)
+        graph_path = os.path.join(MODEL_DIR, 'classify_image_graph_def.pb')
+
+        if not os.path.exists(graph_path):
+            if not os.path.exists(filepath):
+                with TqdmUpTo(unit='B', unit_scale=True, miniters=1,
+                              desc=filename) as t:
+                    filepath, _ = urllib.request.urlretrieve(
+                        DATA_URL, filepath, reporthook=t.update_to)
+            tarfile.open(filepath, 'r:gz').extractall(MODEL_DIR)
+
+        # kept in a graph of its own, apart from the training graph
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            with tf.gfile.FastGFile(graph_path, 'rb') as f:
+                serialized = f.read()
+                self.graph_hash = hashlib.sha1(serialized).hexdigest()
+                graph_def = tf.GraphDef()
+                graph_def.ParseFromString(serialized)
+                tf.import_graph_def(graph_def, name='')
+
+            self.sess = sess = tf.Session(graph=self.graph, config=config)
+            #with sess:
+            pool3 = sess.graph.get_tensor_by_name('pool_3:0')
+            ops = pool3.graph.get_operations()
+            for op_idx, op in enumerate(ops):
+                for o in op.outputs:
+                    shape = [s.value for s in o.get_shape()]
+                    if len(shape) and shape[0] == 1:
+                        shape[0] = batch_size
+                    o._shape = tf.TensorShape(shape)
+            w = sess.graph.get_operation_by_name(
+                "softmax/logits/MatMul").inputs[1]
+            self.coder = tf.squeeze(tf.squeeze(pool3, 2), 1)
+            logits = tf.matmul(self.coder, w)
+            self.softmax = tf.nn.softmax(logits)
+            self.graph.finalize()
 
         assert self.coder.get_shape()[1].value == self.coder_dim
         assert self.softmax.get_shape()[1].value == self.softmax_dim
@@ -67,15 +79,19 @@ class Inception(object):
 
 
 class LeNet(object):
-    def __init__(self):
+    def __init__(self, batch_size=None, config=None):
         MODEL_DIR = 'lenet/saved_model'
         self.softmax_dim = 10
         self.coder_dim = 512
+        self.batch_size = batch_size
+        self.graph_hash = _directory_hash(MODEL_DIR)
 
-        self.sess = sess = tf.Session()
+        self.graph = tf.Graph()
+        self.sess = sess = tf.Session(graph=self.graph, config=config)
 
-        tf.saved_model.loader.load(
-            sess, [tf.saved_model.tag_constants.TRAINING], MODEL_DIR)
+        with self.graph.as_default():
+            tf.saved_model.loader.load(
+                sess, [tf.saved_model.tag_constants.TRAINING], MODEL_DIR)
         g = sess.graph
 
         self.softmax = g.get_tensor_by_name('Softmax_1:0')
@@ -86,25 +102,178 @@ class LeNet(object):
         self.input = 'Placeholder_2:0'
 
 
+_models = {}
+
+
+def load_model(name, batch_size=None, config=None):
+    """
+    Returns the 'inception' or 'lenet' model, loaded only once per process
+    and batch size. config: tf.ConfigProto of the model's session, used when
+    the model is first loaded.
+    """
+    models = {'inception': Inception, 'lenet': LeNet}
+    if name not in models:
+        raise ValueError("bad model {}".format(name))
+    if (name, batch_size) not in _models:
+        _models[name, batch_size] = models[name](batch_size=batch_size, config=config)
+    return _models[name, batch_size]
+
+
+def _directory_hash(path):
+    h = hashlib.sha1()
+    for root, dirs, files in sorted(os.walk(path)):
+        for name in sorted(files):
+            h.update(os.path.relpath(os.path.join(root, name), path).encode())
+            with open(os.path.join(root, name), 'rb') as f:
+                for chunk in iter(lambda: f.read(2**20), b''):
+                    h.update(chunk)
+    return h.hexdigest()
+
+
+def _code_ident(code):
+    # nested functions and lambdas are code objects among the constants, whose
+    # repr contains their address; identify them by their own code instead
+    consts = tuple(_code_ident(c) if hasattr(c, 'co_code') else c
+                   for c in code.co_consts)
+    return repr((code.co_code, consts, code.co_names))
+
+
+def _hash_part(h, part, seen=()):
+    if isinstance(part, np.ndarray):
+        h.update(repr((part.shape, part.dtype.str)).encode())
+        flat = part.reshape(len(part), -1) if part.ndim else part.reshape(1)
+        for start in range(0, len(flat), 1024):
+            h.update(np.ascontiguousarray(flat[start:start + 1024]).data)
+    elif hasattr(part, 'graph_hash'):
+        h.update(part.graph_hash.encode())
+    elif callable(part):
+        code = getattr(part, '__code__', None)
+        if code is None:
+            h.update(('%s.%s' % (getattr(part, '__module__', ''),
+                                 getattr(part, '__name__', repr(part)))).encode())
+            return
+        if id(part) in seen:  # recursive nested function
+            h.update(b'<recursion>')
+            return
+        seen += (id(part),)
+        h.update(_code_ident(code).encode())
+        # the same code with other defaults or captured values is another function
+        for value in (part.__defaults__ or ()):
+            _hash_part(h, value, seen)
+        h.update(repr(sorted((part.__kwdefaults__ or {}).items())).encode())
+        for cell in (part.__closure__ or ()):
+            try:
+                value = cell.cell_contents
+            except ValueError:  # not assigned yet
+                h.update(b'<empty cell>')
+                continue
+            _hash_part(h, value, seen)
+    else:
+        h.update(repr(part).encode())
+
+
+class CodesCache(object):
+    """
+    Content-addressed store of featurize outputs. Entries are float32 .npy
+    files, returned memory-mapped, and keyed by the hash of the images, the
+    model graph and the transformer code, so a change to any of them is a
+    miss rather than a stale hit. The least recently used entries are
+    evicted once the directory exceeds budget bytes.
+    """
+    def __init__(self, directory, budget=20 * 2**30):
+        self.directory = directory
+        self.budget = budget
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+    @staticmethod
+    def key(*parts):
+        """
+        parts: arrays (hashed by content), models (by graph_hash), callables
+            (by code, defaults and closure contents) or anything with a
+            stable repr
+        """
+        h = hashlib.sha1()
+        for part in parts:
+            _hash_part(h, part)
+        return h.hexdigest()
+
+    def _path(self, key, kind):
+        return os.path.join(self.directory, '%s-%s.npy' % (key, kind))
+
+    def get(self, key, kind):
+        path = self._path(key, kind)
+        if not os.path.exists(path):
+            return None
+        os.utime(path, None)  # mark as recently used
+        return np.load(path, mmap_mode='r')
+
+    def put(self, key, kind, array):
+        path = self._path(key, kind)
+        with open(path + '.tmp', 'wb') as f:
+            np.save(f, np.asarray(array, dtype=np.float32))
+        os.rename(path + '.tmp', path)
+        self.evict()
+        return self.get(key, kind)
+
+    def evict(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith('.npy'):
+                st = os.stat(os.path.join(self.directory, name))
+                entries.append((st.st_mtime, st.st_size, name))
+        entries.sort()
+        total = sum(size for _, size, _ in entries)
+        # never evict the most recent entry
+        for _, size, name in entries[:-1]:
+            if total <= self.budget:
+                break
+            os.remove(os.path.join(self.directory, name))
+            total -= size
+
+    def featurize(self, images, model, transformer=np.asarray,
+                  get_preds=True, get_codes=False, **kwargs):
+        """
+        Same as featurize, but only runs the network on a cache miss.
+        """
+        key = self.key(np.asarray(images), model, transformer)
+        kinds = [kind for kind, need in [('preds', get_preds),
+                                         ('codes', get_codes)] if need]
+        ret = tuple(self.get(key, kind) for kind in kinds)
+        if all(r is not None for r in ret):
+            print('[*] Loaded cached %s for key %s' % (' and '.join(kinds), key))
+            return ret
+        ret = featurize(images, model, transformer=transformer,
+                        get_preds=get_preds, get_codes=get_codes, **kwargs)
+        return tuple(self.put(key, kind, r) for kind, r in zip(kinds, ret))
+
+
 def featurize(images, model, batch_size=100, transformer=np.asarray,
               get_preds=True, get_codes=False, output=sys.stdout, 
-              out_preds=None, out_codes=None):
+              out_preds=None, out_codes=None, n_workers=4, queue_depth=4,
+              moments=None):
     '''
     images: a list of numpy arrays with values in [0, 255]
+    moments: optional CodeMoments, updated with the codes of every batch
+    n_workers: threads transforming, clipping and padding the upcoming
+        batches while the session runs the current one; 0 does it inline
+    queue_depth: number of prepared batches to keep in flight
     '''
     sub = transformer(images[:10])
     assert(sub.ndim == 4)
     if isinstance(model, Inception):
         assert sub.shape[3] == 3
-        if (sub.max() > 255) or (sub.min() < 0):
-            print('WARNING! Inception min/max violated: min = %f, max = %f. Clipping values.' % (sub.min(), sub.max()))
-            sub = sub.clip(0., 255.)
+        clip = (0., 255.)
+        batch_size = getattr(model, 'batch_size', None) or batch_size
     elif isinstance(model, LeNet):
-        batch_size = 64
+        batch_size = getattr(model, 'batch_size', None) or 64
         assert sub.shape[3] == 1
-        if (sub.max() > .5) or (sub.min() < -.5):
-            print('WARNING! LeNet min/max violated: min = %f, max = %f. Clipping values.' % (sub.min(), sub.max()))
-            sub = sub.clip(-.5, .5)
+        clip = (-.5, .5)
+    else:
+        clip = (-np.inf, np.inf)
+    if (sub.max() > clip[1]) or (sub.min() < clip[0]):
+        print('WARNING! %s min/max violated: min = %f, max = %f. Clipping values.' % (
+            type(model).__name__, sub.min(), sub.max()))
 
     n = len(images)
 
@@ -130,28 +299,58 @@ def featurize(images, model, batch_size=100, transformer=np.asarray,
             codes = np.empty((n, model.coder_dim), dtype=np.float32)
             codes.fill(np.nan)
         ret += (codes,)
+    if moments is not None and not get_codes:
+        to_get += (model.coder,)
+
+    def prepare(start):
+        end = min(start + batch_size, n)
+        inp = transformer(images[start:end])
+        if inp.dtype.kind == 'f':  # integer images are in range already
+            inp = np.clip(inp, *clip)
+        if end - start != batch_size:
+            pad = batch_size - (end - start)
+            extra = np.zeros((pad,) + inp.shape[1:], dtype=inp.dtype)
+            inp = np.r_[inp, extra]
+        return inp
+
+    starts = iter(range(0, n, batch_size))
+    pool = ThreadPool(n_workers) if n_workers > 0 else None
+    pending = collections.deque()
+
+    def enqueue():
+        start = next(starts, None)
+        if start is None:
+            return
+        if pool is None:
+            pending.append((start, prepare(start)))
+        else:
+            pending.append((start, pool.apply_async(prepare, (start,))))
 
     # with model.sess:
-    with TqdmUpTo(unit='img', unit_scale=True, total=n, file=output) as t:
-        for start in range(0, n, batch_size):
-            t.update_to(start)
-            end = min(start + batch_size, n)
-            inp = transformer(images[start:end])
-
-            if end - start != batch_size:
-                pad = batch_size - (end - start)
-                extra = np.zeros((pad,) + inp.shape[1:], dtype=inp.dtype)
-                inp = np.r_[inp, extra]
+    try:
+        with TqdmUpTo(unit='img', unit_scale=True, total=n, file=output) as t:
+            for _ in range(max(queue_depth, 1)):
+                enqueue()
+            while pending:
+                start, inp = pending.popleft()
+                if pool is not None:
+                    inp = inp.get()
+                enqueue()
+                t.update_to(start)
+                end = min(start + batch_size, n)
                 w = slice(0, end - start)
-            else:
-                w = slice(None)
-
-            out = model.sess.run(to_get, {model.input: inp})
-            if get_preds:
-                preds[start:end] = out[0][w]
-            if get_codes:
-                codes[start:end] = out[-1][w]
-        t.update_to(n)
+
+                out = model.sess.run(to_get, {model.input: inp})
+                if get_preds:
+                    preds[start:end] = out[0][w]
+                if get_codes:
+                    codes[start:end] = out[-1][w]
+                if moments is not None:
+                    moments.update(out[-1][w])
+            t.update_to(n)
+    finally:
+        if pool is not None:
+            pool.terminate()
     return ret
 
 
@@ -165,61 +364,249 @@ def get_splits(n, splits=10, split_method='openai'):
         raise ValueError("bad split_method {}".format(split_method))
 
 
-def inception_score(preds, **split_args):
+def inception_score(preds, chunk_size=4096, **split_args):
+    """
+    All splits are evaluated together: each is a vector of draw counts over
+    the samples, so split marginals and mean entropies are count-weighted
+    sums, accumulated over chunks of preds with one log per entry.
+    """
     split_inds = get_splits(preds.shape[0], **split_args)
-    scores = np.zeros(len(split_inds))
-    for i, inds in enumerate(split_inds):
-        part = preds[inds]
-        kl = part * (np.log(part) - np.log(np.mean(part, 0, keepdims=True)))
-        kl = np.mean(np.sum(kl, 1))
-        scores[i] = np.exp(kl)
-    return scores
-
-
-def fid_score(codes_g, codes_r, eps=1e-6, output=sys.stdout, **split_args):
+    n, k = preds.shape
+    counts = _split_counts(n, split_inds)
+    marginals = np.zeros((len(split_inds), k))
+    neg_entropy = np.zeros(len(split_inds))
+    for start in range(0, n, chunk_size):
+        part = np.asarray(preds[start:start + chunk_size], dtype=np.float64)
+        c = counts[:, start:start + chunk_size]
+        marginals += c.dot(part)
+        neg_entropy += c.dot(np.sum(part * np.log(part), 1))
+    sizes = counts.sum(axis=1)
+    marginals /= sizes[:, None]
+    # mean KL(p(y|x) || p(y)) = E[sum p log p] - sum p(y) log p(y)
+    kl = neg_entropy / sizes - np.sum(marginals * np.log(marginals), 1)
+    return np.exp(kl)
+
+
+def _split_counts(n, splits):
+    # how many times each of n samples is in each split
+    return np.stack([np.bincount(np.arange(n)[w], minlength=n)
+                     for w in splits]).astype(np.float64)
+
+
+class CodeMoments(object):
+    """
+    Mean and covariance of codes, accumulated chunk by chunk in float64 with
+    the pairwise update of Chan et al., so that a reference set only has to
+    be summarized once.
+    """
+    def __init__(self, dim):
+        self.dim = dim
+        self.n = 0
+        self.mean = np.zeros(dim)
+        self.M2 = np.zeros((dim, dim))
+        self._sqrt_cov = None
+
+    def update(self, codes):
+        codes = np.asarray(codes, dtype=np.float64)
+        k = codes.shape[0]
+        if k == 0:
+            return self
+        assert codes.shape[1] == self.dim
+        mean = codes.mean(axis=0)
+        centered = codes - mean
+        delta = mean - self.mean
+        n = self.n + k
+        self.M2 += centered.T.dot(centered)
+        self.M2 += np.outer(delta, delta) * (self.n * k / n)
+        self.mean += delta * (k / n)
+        self.n = n
+        self._sqrt_cov = None
+        return self
+
+    @property
+    def cov(self):
+        return self.M2 / (self.n - 1)
+
+    @property
+    def sqrt_cov(self):
+        # cached, since the reference factor is the same for every FID split
+        if self._sqrt_cov is None:
+            self._sqrt_cov = _sqrt_psd(self.cov)
+        return self._sqrt_cov
+
+    @classmethod
+    def from_codes(cls, codes, chunk_size=4096):
+        moments = cls(codes.shape[1])
+        for start in range(0, codes.shape[0], chunk_size):
+            moments.update(codes[start:start + chunk_size])
+        return moments
+
+    def save(self, path):
+        with open(path + '.tmp', 'wb') as f:
+            np.savez(f, n=self.n, mean=self.mean, M2=self.M2)
+        os.rename(path + '.tmp', path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as f:
+            moments = cls(f['mean'].shape[0])
+            moments.n = int(f['n'])
+            moments.mean = f['mean']
+            moments.M2 = f['M2']
+        return moments
+
+
+def fid_score(codes_g, codes_r, eps=1e-6, output=sys.stdout,
+              sqrt_method='sqrtm', **split_args):
+    """
+    codes_r may also be the CodeMoments of the reference codes; they are then
+    used whole for every split, only the generated codes are split.
+    sqrt_method: 'sqrtm' takes the full matrix square root of cov_g cov_r;
+        'eigh' only its trace, from the eigenvalues of the symmetric
+        sqrt(cov_r) cov_g sqrt(cov_r)
+    """
     splits_g = get_splits(codes_g.shape[0], **split_args)
-    splits_r = get_splits(codes_r.shape[0], **split_args)
-    assert len(splits_g) == len(splits_r)
     d = codes_g.shape[1]
-    assert codes_r.shape[1] == d
+    if isinstance(codes_r, CodeMoments):
+        assert codes_r.dim == d
+        splits_r = [None] * len(splits_g)
+    else:
+        splits_r = get_splits(codes_r.shape[0], **split_args)
+        assert codes_r.shape[1] == d
+    assert len(splits_g) == len(splits_r)
+
+    moments_g = _split_moments(codes_g, splits_g)
+    if isinstance(codes_r, CodeMoments):
+        moments_r = [None] * len(splits_g)
+    else:
+        moments_r = _split_moments(codes_r, splits_r)
 
     scores = np.zeros(len(splits_g))
-    with tqdm(splits_g, desc='FID', file=output) as bar:
-        for i, (w_g, w_r) in enumerate(zip(bar, splits_r)):
-            part_g = codes_g[w_g]
-            part_r = codes_r[w_r]
+    with tqdm(moments_g, desc='FID', file=output) as bar:
+        for i, ((mn_g, cov_g), m_r) in enumerate(zip(bar, moments_r)):
+            if m_r is None:
+                mn_r = codes_r.mean
+                cov_r = codes_r.cov
+                sqrt_cov_r = codes_r.sqrt_cov if sqrt_method == 'eigh' else None
+            else:
+                mn_r, cov_r = m_r
+                sqrt_cov_r = None
+
+            scores[i] = _fid(mn_g, cov_g, mn_r, cov_r, eps,
+                             sqrt_method=sqrt_method, sqrt_cov_r=sqrt_cov_r)
+            bar.set_postfix({'mean': scores[:i+1].mean()})
+    return scores
 
-            mn_g = part_g.mean(axis=0)
-            mn_r = part_r.mean(axis=0)
 
-            cov_g = np.cov(part_g, rowvar=False)
-            cov_r = np.cov(part_r, rowvar=False)
+def _split_moments(codes, splits, chunk_size=4096):
+    """
+    Means and covariances of codes[w] for every w in splits. Bootstrap
+    splits (index arrays) are not gathered: each becomes a vector of draw
+    counts, and the moments of all of them are accumulated as count-weighted
+    sums in a single pass over chunks of the codes.
+    """
+    if all(isinstance(w, slice) for w in splits):
+        # views, no copies involved
+        return [(codes[w].mean(axis=0), np.cov(codes[w], rowvar=False))
+                for w in splits]
+
+    n, d = codes.shape
+    counts = _split_counts(n, splits)
+    sizes = counts.sum(axis=1)
+    # shifting by the overall mean keeps the second moments well conditioned
+    shift = codes.mean(axis=0, dtype=np.float64)
+    sums = np.zeros((len(splits), d))
+    second = np.zeros((len(splits), d, d))
+    for start in range(0, n, chunk_size):
+        chunk = np.asarray(codes[start:start + chunk_size], dtype=np.float64)
+        chunk -= shift
+        c = counts[:, start:start + chunk_size]
+        sums += c.dot(chunk)
+        for i in range(len(splits)):
+            # rows drawn k times weigh sqrt(k) on both sides of the product,
+            # rows never drawn are skipped
+            nz = np.flatnonzero(c[i])
+            part = chunk[nz]
+            part *= np.sqrt(c[i, nz, None])
+            second[i] += part.T.dot(part)
+
+    moments = []
+    for i in range(len(splits)):
+        mn = sums[i] / sizes[i]
+        cov = (second[i] - sizes[i] * np.outer(mn, mn)) / (sizes[i] - 1)
+        moments.append((mn + shift, cov))
+    return moments
+
+
+def _fid(mn_g, cov_g, mn_r, cov_r, eps=1e-6, sqrt_method='sqrtm',
+         sqrt_cov_r=None):
+    if sqrt_method == 'eigh':
+        if sqrt_cov_r is None:
+            sqrt_cov_r = _sqrt_psd(cov_r)
+        # cov_g cov_r is similar to sqrt(cov_r) cov_g sqrt(cov_r), which is
+        # symmetric PSD, so they share their eigenvalues
+        M = sqrt_cov_r.dot(cov_g).dot(sqrt_cov_r)
+        ev = linalg.eigvalsh((M + M.T) / 2)
+        trace_covmean = np.sqrt(np.maximum(ev, 0)).sum()
+    elif sqrt_method == 'sqrtm':
+        d = cov_g.shape[0]
+        covmean, _ = linalg.sqrtm(cov_g.dot(cov_r), disp=False)
+        if not np.isfinite(covmean).all():
+            cov_g[range(d), range(d)] += eps
+            cov_r[range(d), range(d)] += eps
+            covmean = linalg.sqrtm(cov_g.dot(cov_r))
+        trace_covmean = np.trace(covmean)
+    else:
+        raise ValueError("bad sqrt_method {}".format(sqrt_method))
 
-            covmean, _ = linalg.sqrtm(cov_g.dot(cov_r), disp=False)
-            if not np.isfinite(covmean).all():
-                cov_g[range(d), range(d)] += eps
-                cov_r[range(d), range(d)] += eps
-                covmean = linalg.sqrtm(cov_g.dot(cov_r))
+    return np.sum((mn_g - mn_r) ** 2) + (
+        np.trace(cov_g) + np.trace(cov_r) - 2 * trace_covmean)
 
-            scores[i] = np.sum((mn_g - mn_r) ** 2) + (
-                np.trace(cov_g) + np.trace(cov_r) - 2 * np.trace(covmean))
-            bar.set_postfix({'mean': scores[:i+1].mean()})
-    return scores
+
+def _sqrt_psd(cov):
+    w, V = linalg.eigh(cov)
+    return (V * np.sqrt(np.maximum(w, 0))).dot(V.T)
 
 
 def polynomial_mmd_averages(codes_g, codes_r, n_subsets=50, subset_size=1000,
-                            ret_var=True, output=sys.stdout, **kernel_args):
+                            ret_var=True, output=sys.stdout,
+                            max_gram_elements=2**27, **kernel_args):
+    """
+    If the kernel matrices over all of codes_g and codes_r are cheaper than
+    those of the subsets together and none of them has more than
+    max_gram_elements entries, they are computed once and every subset
+    gathers its kernel matrices from them. Otherwise each subset goes through
+    the blocked polynomial_mmd.
+    """
     m = min(codes_g.shape[0], codes_r.shape[0])
     mmds = np.zeros(n_subsets)
     if ret_var:
         vars = np.zeros(n_subsets)
     choice = np.random.choice
 
+    n_g, n_r = len(codes_g), len(codes_r)
+    union = ((n_g * n_g + n_r * n_r + n_g * n_r < 3 * n_subsets * subset_size**2)
+             and (max(n_g, n_r)**2 <= max_gram_elements))
+    if union:
+        kernel_args.pop('block_size', None)
+        K_XX = _polynomial_block(codes_g, codes_g, **kernel_args)
+        K_YY = _polynomial_block(codes_r, codes_r, **kernel_args)
+        K_XY = _polynomial_block(codes_g, codes_r, **kernel_args)
+
     with tqdm(range(n_subsets), desc='MMD', file=output) as bar:
         for i in bar:
-            g = codes_g[choice(len(codes_g), subset_size, replace=False)]
-            r = codes_r[choice(len(codes_r), subset_size, replace=False)]
-            o = polynomial_mmd(g, r, **kernel_args, var_at_m=m, ret_var=ret_var)
+            g = choice(len(codes_g), subset_size, replace=False)
+            r = choice(len(codes_r), subset_size, replace=False)
+            if union:
+                # the estimates do not depend on the order within a subset;
+                # sorted rows are gathered faster
+                g, r = np.sort(g), np.sort(r)
+                o = _mmd2_and_variance(_gather(K_XX, g, g), _gather(K_XY, g, r),
+                                       _gather(K_YY, r, r),
+                                       var_at_m=m, ret_var=ret_var)
+            else:
+                o = polynomial_mmd(codes_g[g], codes_r[r], **kernel_args,
+                                   var_at_m=m, ret_var=ret_var)
             if ret_var:
                 mmds[i], vars[i] = o
             else:
@@ -228,19 +615,93 @@ def polynomial_mmd_averages(codes_g, codes_r, n_subsets=50, subset_size=1000,
     return (mmds, vars) if ret_var else mmds
 
 
+def _gather(K, rows, cols):
+    # take keeps the result C-contiguous, unlike K[rows][:, cols]
+    return _float64(K.take(rows, axis=0).take(cols, axis=1))
+
+
 def polynomial_mmd(codes_g, codes_r, degree=3, gamma=None, coef0=1,
-                   var_at_m=None, ret_var=True):
+                   var_at_m=None, ret_var=True, block_size=1024):
     # use  k(x, y) = (gamma <x, y> + coef0)^degree
     # default gamma is 1 / dim
     X = codes_g
     Y = codes_r
-
-    K_XX = polynomial_kernel(X, degree=degree, gamma=gamma, coef0=coef0)
-    K_YY = polynomial_kernel(Y, degree=degree, gamma=gamma, coef0=coef0)
-    K_XY = polynomial_kernel(X, Y, degree=degree, gamma=gamma, coef0=coef0)
-
-    return _mmd2_and_variance(K_XX, K_XY, K_YY,
-                              var_at_m=var_at_m, ret_var=ret_var)
+    assert X.shape == Y.shape
+    kernel_args = dict(degree=degree, gamma=gamma, coef0=coef0)
+
+    # the kernel matrices are never formed in full, only block_size squared
+    # blocks of them at a time
+    Kt_XX_sums, Kt_XX_2_sum, sum_diag_X = _symmetric_block_sums(
+        X, block_size, **kernel_args)
+    Kt_YY_sums, Kt_YY_2_sum, sum_diag_Y = _symmetric_block_sums(
+        Y, block_size, **kernel_args)
+    K_XY_sums_0, K_XY_sums_1, K_XY_2_sum, trace_XY = _cross_block_sums(
+        X, Y, block_size, **kernel_args)
+
+    return _mmd2_and_variance_from_sums(
+        Kt_XX_sums, Kt_YY_sums, K_XY_sums_0, K_XY_sums_1,
+        sum_diag_X, sum_diag_Y, Kt_XX_2_sum, Kt_YY_2_sum, K_XY_2_sum,
+        trace_XY, m=X.shape[0], var_at_m=var_at_m, ret_var=ret_var)
+
+
+def _polynomial_block(X, Y, degree=3, gamma=None, coef0=1):
+    # same as sklearn's polynomial_kernel, in place on the BLAS output
+    if gamma is None:
+        gamma = 1.0 / X.shape[1]
+    K = X.dot(Y.T)
+    K *= gamma
+    K += coef0
+    K **= degree
+    return K
+
+
+def _blocks(n, block_size):
+    return [slice(i, min(i + block_size, n)) for i in range(0, n, block_size)]
+
+
+def _float64(K):
+    # blocks are computed in the precision of the codes, but their sums are
+    # accumulated in float64: over 10k x 10k entries float32 sums drift
+    return K.astype(np.float64, copy=False)
+
+
+def _symmetric_block_sums(X, block_size=1024, **kernel_args):
+    # only blocks on or above the diagonal are computed, the ones below are
+    # their transposes
+    blocks = _blocks(X.shape[0], block_size)
+    Kt_XX_sums = np.zeros(X.shape[0])
+    K_XX_2_sum = sum_diag_X = sum_diag2_X = 0
+    for i, bi in enumerate(blocks):
+        for bj in blocks[i:]:
+            K = _float64(_polynomial_block(X[bi], X[bj], **kernel_args))
+            Kt_XX_sums[bi] += K.sum(axis=1)
+            if bi == bj:
+                diag = np.diagonal(K)
+                Kt_XX_sums[bi] -= diag
+                sum_diag_X += diag.sum()
+                sum_diag2_X += _sqn(diag)
+                K_XX_2_sum += _sqn(K)
+            else:
+                Kt_XX_sums[bj] += K.sum(axis=0)
+                K_XX_2_sum += 2 * _sqn(K)
+    return Kt_XX_sums, K_XX_2_sum - sum_diag2_X, sum_diag_X
+
+
+def _cross_block_sums(X, Y, block_size=1024, **kernel_args):
+    blocks_X = _blocks(X.shape[0], block_size)
+    blocks_Y = _blocks(Y.shape[0], block_size)
+    K_XY_sums_0 = np.zeros(Y.shape[0])
+    K_XY_sums_1 = np.zeros(X.shape[0])
+    K_XY_2_sum = trace_XY = 0
+    for bi in blocks_X:
+        for bj in blocks_Y:
+            K = _float64(_polynomial_block(X[bi], Y[bj], **kernel_args))
+            K_XY_sums_0[bj] += K.sum(axis=0)
+            K_XY_sums_1[bi] += K.sum(axis=1)
+            K_XY_2_sum += _sqn(K)
+            if bi == bj:
+                trace_XY += np.trace(K)
+    return K_XY_sums_0, K_XY_sums_1, K_XY_2_sum, trace_XY
 
 
 def _sqn(arr):
@@ -249,17 +710,15 @@ def _sqn(arr):
 
 
 def _mmd2_and_variance(K_XX, K_XY, K_YY, unit_diagonal=False,
-                       mmd_est='unbiased', block_size=1024,
-                       var_at_m=None, ret_var=True):
+                       mmd_est='unbiased', var_at_m=None, ret_var=True):
     # based on
     # https://github.com/dougalsutherland/opt-mmd/blob/master/two_sample/mmd.py
-    # but changed to not compute the full kernel matrix at once
+    # see polynomial_mmd for the blocked version, which does not compute the
+    # full kernel matrix at once
     m = K_XX.shape[0]
     assert K_XX.shape == (m, m)
     assert K_XY.shape == (m, m)
     assert K_YY.shape == (m, m)
-    if var_at_m is None:
-        var_at_m = m
 
     # Get the various sums of kernels that we'll use
     # Kts drop the diagonal, but we don't need to compute them explicitly
@@ -277,10 +736,21 @@ def _mmd2_and_variance(K_XX, K_XY, K_YY, unit_diagonal=False,
         sum_diag2_X = _sqn(diag_X)
         sum_diag2_Y = _sqn(diag_Y)
 
-    Kt_XX_sums = K_XX.sum(axis=1) - diag_X
-    Kt_YY_sums = K_YY.sum(axis=1) - diag_Y
-    K_XY_sums_0 = K_XY.sum(axis=0)
-    K_XY_sums_1 = K_XY.sum(axis=1)
+    return _mmd2_and_variance_from_sums(
+        K_XX.sum(axis=1) - diag_X, K_YY.sum(axis=1) - diag_Y,
+        K_XY.sum(axis=0), K_XY.sum(axis=1), sum_diag_X, sum_diag_Y,
+        _sqn(K_XX) - sum_diag2_X, _sqn(K_YY) - sum_diag2_Y, _sqn(K_XY),
+        np.trace(K_XY), m=m, mmd_est=mmd_est, var_at_m=var_at_m,
+        ret_var=ret_var)
+
+
+def _mmd2_and_variance_from_sums(Kt_XX_sums, Kt_YY_sums, K_XY_sums_0,
+                                 K_XY_sums_1, sum_diag_X, sum_diag_Y,
+                                 Kt_XX_2_sum, Kt_YY_2_sum, K_XY_2_sum,
+                                 trace_XY, m, mmd_est='unbiased',
+                                 var_at_m=None, ret_var=True):
+    if var_at_m is None:
+        var_at_m = m
 
     Kt_XX_sum = Kt_XX_sums.sum()
     Kt_YY_sum = Kt_YY_sums.sum()
@@ -296,15 +766,11 @@ def _mmd2_and_variance(K_XX, K_XY, K_YY, unit_diagonal=False,
         if mmd_est == 'unbiased':
             mmd2 -= 2 * K_XY_sum / (m * m)
         else:
-            mmd2 -= 2 * (K_XY_sum - np.trace(K_XY)) / (m * (m-1))
+            mmd2 -= 2 * (K_XY_sum - trace_XY) / (m * (m-1))
 
     if not ret_var:
         return mmd2
 
-    Kt_XX_2_sum = _sqn(K_XX) - sum_diag2_X
-    Kt_YY_2_sum = _sqn(K_YY) - sum_diag2_Y
-    K_XY_2_sum = _sqn(K_XY)
-
     dot_XX_XY = Kt_XX_sums.dot(K_XY_sums_1)
     dot_YY_YX = Kt_YY_sums.dot(K_XY_sums_0)
 
@@ -340,16 +806,30 @@ def main():
     parser.add_argument('samples')
     parser.add_argument('reference_feats', nargs='?')
     parser.add_argument('--output', '-o')
+    parser.add_argument('--reference-moments', metavar='NPZ',
+                        help='mean/covariance of the reference codes for FID; '
+                             'computed from REFERENCE_FEATS and saved here if '
+                             'the file does not exist yet')
 
     parser.add_argument('--reference-subset', default=slice(None),
                         type=lambda x: slice(*(int(s) if s else None
                                                for s in x.split(':'))))
 
     parser.add_argument('--batch-size', type=int, default=128)
+    parser.add_argument('--fixed-batch-size', action='store_true', default=False,
+                        help='build the model graph for exactly --batch-size')
+    parser.add_argument('--featurize-workers', type=int, default=4)
+    parser.add_argument('--featurize-queue-depth', type=int, default=4)
 
     parser.add_argument('--model', choices=['inception', 'lenet'],
                         default='inception')
 
+    parser.add_argument('--codes-cache', metavar='DIR',
+                        help='reuse codes/preds of identical samples, model '
+                             'and transformer from this directory')
+    parser.add_argument('--codes-cache-budget', type=float, default=20,
+                        help='size of the codes cache in GB')
+
     g = parser.add_mutually_exclusive_group()
     g.add_argument('--save-codes')
     g.add_argument('--load-codes')
@@ -375,18 +855,24 @@ def main():
 
     parser.add_argument('--mmd-subsets', type=int, default=100)
     parser.add_argument('--mmd-subset-size', type=int, default=1000)
+    parser.add_argument('--mmd-block-size', type=int, default=1024)
     g = parser.add_mutually_exclusive_group()
     g.add_argument('--mmd-var', action='store_true', default=False)
     g.add_argument('--no-mmd-var', action='store_false', dest='mmd_var')
 
+    parser.add_argument('--fid-sqrt-method', choices=['sqrtm', 'eigh'],
+                        default='sqrtm')
+
     parser.add_argument('--splits', type=int, default=10)
     parser.add_argument('--split-method', choices=['openai', 'bootstrap'],
                         default='bootstrap')
 
     args = parser.parse_args()
 
-    if args.do_fid and args.reference_feats is None:
-        parser.error("Need REFERENCE_FEATS if you're doing FID")
+    if args.do_fid and args.reference_feats is None and not (
+            args.reference_moments and os.path.exists(args.reference_moments)):
+        parser.error("Need REFERENCE_FEATS or existing --reference-moments "
+                     "if you're doing FID")
 
     def check_path(pth):
         if os.path.exists(pth):
@@ -400,8 +886,9 @@ def main():
 
     samples = np.load(args.samples, mmap_mode='r')
 
+    model_batch_size = args.batch_size if args.fixed_batch_size else None
     if args.model == 'inception':
-        model = Inception()
+        model = load_model('inception', model_batch_size)
         if samples.dtype == np.uint8:
             transformer = np.asarray
         elif samples.dtype == np.float32:
@@ -411,7 +898,7 @@ def main():
         else:
             raise TypeError("don't know how to handle {}".format(samples.dtype))
     elif args.model == 'lenet':
-        model = LeNet()
+        model = load_model('lenet', model_batch_size)
         if samples.dtype == np.uint8:
             def transformer(x):
                 return (np.asarray(x, dtype=np.float32) - (255 / 2.)) / 255
@@ -427,6 +914,12 @@ def main():
     if args.reference_feats:
         ref_feats = np.load(args.reference_feats, mmap_mode='r')[
                 args.reference_subset]
+    if args.reference_moments:
+        if os.path.exists(args.reference_moments):
+            ref_moments = CodeMoments.load(args.reference_moments)
+        else:
+            ref_moments = CodeMoments.from_codes(ref_feats)
+            ref_moments.save(args.reference_moments)
 
     out_kw = {}
     if args.save_codes:
@@ -460,9 +953,22 @@ def main():
         elif need_preds:
             raise NotImplementedError()
     else:
-        out = featurize(
-            samples, model, batch_size=args.batch_size, transformer=transformer,
-            get_preds=need_preds, get_codes=need_codes, **out_kw)
+        featurize_kw = dict(
+            batch_size=args.batch_size, transformer=transformer,
+            get_preds=need_preds, get_codes=need_codes,
+            n_workers=args.featurize_workers,
+            queue_depth=args.featurize_queue_depth)
+        if args.codes_cache:
+            cache = CodesCache(args.codes_cache,
+                               budget=int(args.codes_cache_budget * 2**30))
+            out = cache.featurize(samples, model, **featurize_kw)
+            if 'out_preds' in out_kw:
+                out_kw['out_preds'][:] = out[0]
+            if 'out_codes' in out_kw:
+                out_kw['out_codes'][:] = out[-1]
+        else:
+            featurize_kw.update(out_kw)
+            out = featurize(samples, model, **featurize_kw)
         if need_preds:
             preds = out[0]
         if need_codes:
@@ -479,7 +985,9 @@ def main():
         print("Inception scores:", scores, sep='\n')
 
     if args.do_fid:
-        output['fid'] = scores = fid_score(codes, ref_feats, **split_args)
+        output['fid'] = scores = fid_score(
+            codes, ref_moments if args.reference_moments else ref_feats,
+            sqrt_method=args.fid_sqrt_method, **split_args)
         print("FID mean:", np.mean(scores))
         print("FID std:", np.std(scores))
         print("FID scores:", scores, sep='\n')
@@ -489,7 +997,8 @@ def main():
         ret = polynomial_mmd_averages(
             codes, ref_feats, degree=args.mmd_degree, gamma=args.mmd_gamma,
             coef0=args.mmd_coef0, ret_var=args.mmd_var,
-            n_subsets=args.mmd_subsets, subset_size=args.mmd_subset_size)
+            n_subsets=args.mmd_subsets, subset_size=args.mmd_subset_size,
+            block_size=args.mmd_block_size)
         if args.mmd_var:
             output['mmd2'], output['mmd2_var'] = mmd2s, vars = ret
         else:
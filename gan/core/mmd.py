@@ -11,163 +11,508 @@ from .ops import dot, sq_sum
 
 mysqrt = lambda x: tf.sqrt(tf.maximum(x + _eps, 0.))
 
-def _distance_kernel(X, Y, K_XY_only=False):
-    XX = tf.matmul(X, X, transpose_b=True)
-    XY = tf.matmul(X, Y, transpose_b=True)
-    YY = tf.matmul(Y, Y, transpose_b=True)
-        
-    X_sqnorms = tf.diag_part(XX)
-    Y_sqnorms = tf.diag_part(YY)
+# row / column vector views; these also work on batches of vectors
+r = lambda x: tf.expand_dims(x, -2)
+c = lambda x: tf.expand_dims(x, -1)
 
-    r = lambda x: tf.expand_dims(x, 0)
-    c = lambda x: tf.expand_dims(x, 1)
 
-    K_XY = c(mysqrt(X_sqnorms)) + r(mysqrt(Y_sqnorms)) - mysqrt(-2 * XY + c(X_sqnorms) + r(Y_sqnorms))
+class Gram(object):
+    """
+    Cache of inner products, squared norms and squared distances between
+    discriminator outputs. A single instance is shared by all kernel
+    evaluations in a training step, so that the loss, the witness function of
+    the gradient penalty and the L2 penalty reuse the same matmuls instead of
+    rebuilding them for every (X, Y) pair.
+    X and Y may also be batches of blocks, of shape [n_blocks, block_size, dim].
+    """
+    def __init__(self):
+        self._memo = {}
+        self._dots = {}
+        self._sqnorms = {}
+        self._sqdists = {}
+
+    def memo(self, key, build):
+        "Memoized result of build(), e.g. random features shared by the loss and the witness."
+        if key not in self._memo:
+            self._memo[key] = build()
+        return self._memo[key]
+
+    def map(self, fn, X):
+        "Memoized elementwise transform of X, e.g. tf.tanh."
+        return self.memo((fn, X), lambda: fn(X))
+
+    def dot(self, X, Y):
+        "Matrix of inner products <x_i, y_j>."
+        if (X, Y) not in self._dots:
+            if (Y, X) in self._dots:
+                self._dots[(X, Y)] = tf.matrix_transpose(self._dots[(Y, X)])
+            else:
+                self._dots[(X, Y)] = tf.matmul(X, Y, transpose_b=True)
+        return self._dots[(X, Y)]
+
+    def sqnorms(self, X):
+        "Vector of squared norms ||x_i||^2."
+        if X not in self._sqnorms:
+            if (X, X) in self._dots:
+                self._sqnorms[X] = tf.matrix_diag_part(self._dots[(X, X)])
+            else:
+                self._sqnorms[X] = tf.reduce_sum(tf.square(X), -1)
+        return self._sqnorms[X]
+
+    def sqdist(self, X, Y):
+        "Matrix of squared distances ||x_i - y_j||^2, clipped at 0."
+        if (X, Y) not in self._sqdists:
+            if (Y, X) in self._sqdists:
+                self._sqdists[(X, Y)] = tf.matrix_transpose(self._sqdists[(Y, X)])
+            else:
+                XY = self.dot(X, Y)
+                self._sqdists[(X, Y)] = tf.maximum(
+                    -2. * XY + c(self.sqnorms(X)) + r(self.sqnorms(Y)), 0.)
+        return self._sqdists[(X, Y)]
+
+
+class FeatureKernel(object):
+    """
+    Kernel given by explicit features, k(x, y) = <phi(x), phi(y)>. Returned by
+    the random feature kernels in place of the (K_XX, K_XY, K_YY, diagonal)
+    tuple; mmd2 and mmd2_and_ratio then run in time linear in the batch size.
+    """
+    def __init__(self, phi_X, phi_Y):
+        self.phi_X = phi_X
+        self.phi_Y = phi_Y
+
+    @staticmethod
+    def _K_2_sum(phi_X, phi_Y):
+        "sum(K_XY ** 2) = ||phi_X^T phi_Y||^2, through the smaller of the two Gram matrices."
+        m, n = int(phi_X.get_shape()[0]), int(phi_Y.get_shape()[0])
+        if int(phi_X.get_shape()[1]) ** 2 < m * n:
+            return sq_sum(tf.matmul(phi_X, phi_Y, transpose_a=True))
+        return sq_sum(tf.matmul(phi_X, phi_Y, transpose_b=True))
+
+    def sums(self):
+        "Statistics of K_XX, K_YY and K_XY, as used by _mmd2_and_variance_from_sums."
+        def symmetric(phi):
+            norms = tf.reduce_sum(tf.square(phi), 1)
+            Kt_sums = tf.matmul(phi, tf.reduce_sum(phi, 0, keep_dims=True),
+                                transpose_b=True)[:, 0] - norms
+            Kt_2_sum = self._K_2_sum(phi, phi) - sq_sum(norms)
+            return Kt_sums, Kt_2_sum, tf.reduce_sum(norms)
+        phi_X, phi_Y = self.phi_X, self.phi_Y
+        K_XY_sums_0 = tf.matmul(phi_Y, tf.reduce_sum(phi_X, 0, keep_dims=True),
+                                transpose_b=True)[:, 0]
+        K_XY_sums_1 = tf.matmul(phi_X, tf.reduce_sum(phi_Y, 0, keep_dims=True),
+                                transpose_b=True)[:, 0]
+        K_XY_2_sum = self._K_2_sum(phi_X, phi_Y)
+        return symmetric(phi_X), symmetric(phi_Y), (K_XY_sums_0, K_XY_sums_1, K_XY_2_sum)
+
+
+def _distance_kernel(X, Y, K_XY_only=False, gram=None):
+    if gram is None:
+        gram = Gram()
+    if not K_XY_only:
+        # build the full Gram matrices first so that norms are read off their diagonals
+        gram.dot(X, X), gram.dot(Y, Y)
+
+    X_norms = mysqrt(gram.sqnorms(X))
+    Y_norms = mysqrt(gram.sqnorms(Y))
+
+    K_XY = c(X_norms) + r(Y_norms) - mysqrt(gram.sqdist(X, Y))
 
     if K_XY_only:
         return K_XY
 
-    K_XX = c(mysqrt(X_sqnorms)) + r(mysqrt(X_sqnorms)) - mysqrt(-2 * XX + c(X_sqnorms) + r(X_sqnorms))
-    K_YY = c(mysqrt(Y_sqnorms)) + r(mysqrt(Y_sqnorms)) - mysqrt(-2 * YY + c(Y_sqnorms) + r(Y_sqnorms))
+    K_XX = c(X_norms) + r(X_norms) - mysqrt(gram.sqdist(X, X))
+    K_YY = c(Y_norms) + r(Y_norms) - mysqrt(gram.sqdist(Y, Y))
         
     return K_XX, K_XY, K_YY, False
 
 
-def _tanh_distance_kernel(X, Y, K_XY_only=False):
-    return _distance_kernel(tf.tanh(X), tf.tanh(Y), K_XY_only=K_XY_only)    
+def _tanh_distance_kernel(X, Y, K_XY_only=False, gram=None):
+    if gram is None:
+        gram = Gram()
+    return _distance_kernel(gram.map(tf.tanh, X), gram.map(tf.tanh, Y),
+                            K_XY_only=K_XY_only, gram=gram)
     
     
-def _dot_kernel(X, Y, K_XY_only=False):
-    K_XY = tf.matmul(X, Y, transpose_b=True)
+def _dot_kernel(X, Y, K_XY_only=False, gram=None):
+    if gram is None:
+        gram = Gram()
+    K_XY = gram.dot(X, Y)
     if K_XY_only:
         return K_XY
     
-    K_XX = tf.matmul(X, X, transpose_b=True)
-    K_YY = tf.matmul(Y, Y, transpose_b=True)  
+    K_XX = gram.dot(X, X)
+    K_YY = gram.dot(Y, Y)
     
     return K_XX, K_XY, K_YY, False
    
     
-def _mix_rbf_kernel(X, Y, sigmas=[2.0, 5.0, 10.0, 20.0, 40.0, 80.0], wts=None, 
-                    K_XY_only=False):
-    if wts is None:
-        wts = [1] * len(sigmas)
-
-    XX = tf.matmul(X, X, transpose_b=True)
-    XY = tf.matmul(X, Y, transpose_b=True)
-    YY = tf.matmul(Y, Y, transpose_b=True)
-        
-    X_sqnorms = tf.diag_part(XX)
-    Y_sqnorms = tf.diag_part(YY)
+def _mixture_consts(params, wts, add_dot=.0, dtype=tf.float32):
+    """
+    Constant tensors of a mixture kernel: per-component parameters (gammas
+    for RBF, alphas for RQ) and weights, both stacked and per component,
+    the sum of weights (i.e. the kernel diagonal) and the dot term scale.
+    """
+    params = tf.constant(params, dtype=dtype)
+    wts = tf.constant(wts, dtype=dtype)
+    return {'params': params, 'wts': wts,
+            'param_list': tf.unstack(params), 'wts_list': tf.unstack(wts),
+            'wts_sum': tf.reduce_sum(wts),
+            'add_dot': tf.constant(add_dot, dtype=dtype)}
 
-    r = lambda x: tf.expand_dims(x, 0)
-    c = lambda x: tf.expand_dims(x, 1)
 
-    K_XX, K_XY, K_YY = 0, 0, 0
-    
-    XYsqnorm = -2 * XY + c(X_sqnorms) + r(Y_sqnorms)
-    for sigma, wt in zip(sigmas, wts):
-        gamma = 1 / (2 * sigma**2)
-        K_XY += wt * tf.exp(-gamma * XYsqnorm)
-        
-    if K_XY_only:
-        return K_XY
-    
-    XXsqnorm = -2 * XX + c(X_sqnorms) + r(X_sqnorms)
-    YYsqnorm = -2 * YY + c(Y_sqnorms) + r(Y_sqnorms)
-    for sigma, wt in zip(sigmas, wts):
-        gamma = 1 / (2 * sigma**2)
-        K_XX += wt * tf.exp(-gamma * XXsqnorm)
-        K_YY += wt * tf.exp(-gamma * YYsqnorm)
-        
-    return K_XX, K_XY, K_YY, tf.reduce_sum(wts)
+def _rbf_consts(sigmas=[2.0, 5.0, 10.0, 20.0, 40.0, 80.0], wts=None, dtype=tf.float32):
+    if wts is None:
+        wts = [1.] * len(sigmas)
+    return _mixture_consts([1 / (2 * sigma**2) for sigma in sigmas], wts, dtype=dtype)
 
 
-def _mix_rq_dot_kernel(X, Y, alphas=[.1, 1., 10.], wts=None, K_XY_only=False):
-    return _mix_rq_kernel(X, Y, alphas=alphas, wts=wts, K_XY_only=K_XY_only, add_dot=.1)
+def _rq_consts(alphas=[.1, 1., 10.], wts=None, add_dot=.0, dtype=tf.float32):
+    if wts is None:
+        wts = [1.] * len(alphas)
+    return _mixture_consts(alphas, wts, add_dot, dtype=dtype)
 
 
-def _mix_rq_1dot_kernel(X, Y, alphas=[.1, 1., 10.], wts=None, K_XY_only=False):
-    return _mix_rq_kernel(X, Y, alphas=alphas, wts=wts, K_XY_only=K_XY_only, add_dot=1.)
-    
+def _stacked(values, like):
+    "Reshapes values to [k, 1, ..., 1], broadcasting against `like` along a new leading axis."
+    return tf.reshape(values, [-1] + [1] * like.get_shape().ndims)
 
-def _mix_rq_10dot_kernel(X, Y, alphas=[.1, 1., 10.], wts=None, K_XY_only=False):
-    return _mix_rq_kernel(X, Y, alphas=alphas, wts=wts, K_XY_only=K_XY_only, add_dot=10.)
 
+def _rbf_mixture(sqdist, consts, fused=False):
+    if fused:
+        # all bandwidths in one broadcasted exp, followed by a single weighted reduction
+        gammas = _stacked(consts['params'], sqdist)
+        return tf.tensordot(consts['wts'], tf.exp(-gammas * sqdist), 1)
+    K = 0.
+    for gamma, wt in zip(consts['param_list'], consts['wts_list']):
+        K += wt * tf.exp(-gamma * sqdist)
+    return K
 
-def _mix_rq_01dot_kernel(X, Y, alphas=[.1, 1., 10.], wts=None, K_XY_only=False):
-    return _mix_rq_kernel(X, Y, alphas=alphas, wts=wts, K_XY_only=K_XY_only, add_dot=.1)
 
+def _rq_mixture(sqdist, consts, fused=False):
+    if fused:
+        a = _stacked(consts['params'], sqdist)
+        return tf.tensordot(consts['wts'], tf.exp(-a * tf.log(1. + sqdist/(2.*a))), 1)
+    K = 0.
+    for alpha, wt in zip(consts['param_list'], consts['wts_list']):
+        log = tf.log(1. + sqdist/(2.*alpha))
+        K += wt * tf.exp(-alpha * log)
+    return K
 
-def _mix_rq_001dot_kernel(X, Y, alphas=[.1, 1., 10.], wts=None, K_XY_only=False):
-    return _mix_rq_kernel(X, Y, alphas=alphas, wts=wts, K_XY_only=K_XY_only, add_dot=.01)
+    
+def _mix_rbf_kernel(X, Y, sigmas=[2.0, 5.0, 10.0, 20.0, 40.0, 80.0], wts=None, 
+                    K_XY_only=False, gram=None, fused=False, consts=None):
+    if consts is None:
+        consts = _rbf_consts(sigmas, wts)
+    if gram is None:
+        gram = Gram()
+    if not K_XY_only:
+        gram.dot(X, X), gram.dot(Y, Y)
+
+    K_XY = _rbf_mixture(gram.sqdist(X, Y), consts, fused)
+        
+    if K_XY_only:
+        return K_XY
+    
+    K_XX = _rbf_mixture(gram.sqdist(X, X), consts, fused)
+    K_YY = _rbf_mixture(gram.sqdist(Y, Y), consts, fused)
+        
+    return K_XX, K_XY, K_YY, consts['wts_sum']
     
     
-def _tanh_mix_rq_kernel(X, Y, K_XY_only=False):
-    return _mix_rq_kernel(tf.tanh(X), tf.tanh(Y), K_XY_only=K_XY_only)  
+def _tanh_mix_rq_kernel(X, Y, K_XY_only=False, gram=None, **kwargs):
+    if gram is None:
+        gram = Gram()
+    return _mix_rq_kernel(gram.map(tf.tanh, X), gram.map(tf.tanh, Y),
+                          K_XY_only=K_XY_only, gram=gram, **kwargs)
         
 
-def _mix_rq_kernel(X, Y, alphas=[.1, 1., 10.], wts=None, K_XY_only=False, add_dot=.0):
+def _mix_rq_kernel(X, Y, alphas=[.1, 1., 10.], wts=None, K_XY_only=False, add_dot=.0,
+                   gram=None, fused=False, consts=None):
     """
     Rational quadratic kernel
     http://www.cs.toronto.edu/~duvenaud/cookbook/index.html
     """
-    if wts is None:
-        wts = [1.] * len(alphas)
-
-    XX = tf.matmul(X, X, transpose_b=True)
-    XY = tf.matmul(X, Y, transpose_b=True)
-    YY = tf.matmul(Y, Y, transpose_b=True)
-
-    X_sqnorms = tf.diag_part(XX)
-    Y_sqnorms = tf.diag_part(YY)
-
-    r = lambda x: tf.expand_dims(x, 0)
-    c = lambda x: tf.expand_dims(x, 1)
-    
-    K_XX, K_XY, K_YY = 0., 0., 0.
-    
-    XYsqnorm = tf.maximum(-2. * XY + c(X_sqnorms) + r(Y_sqnorms), 0.)
-    
-    for alpha, wt in zip(alphas, wts):
-        logXY = tf.log(1. + XYsqnorm/(2.*alpha))
-        K_XY += wt * tf.exp(-alpha * logXY)
+    if consts is None:
+        consts = _rq_consts(alphas, wts, add_dot)
+    if gram is None:
+        gram = Gram()
+    if not K_XY_only:
+        gram.dot(X, X), gram.dot(Y, Y)
+
+    K_XY = _rq_mixture(gram.sqdist(X, Y), consts, fused)
     if add_dot > 0:
-        K_XY += tf.cast(add_dot, tf.float32) * XY
+        K_XY += consts['add_dot'] * gram.dot(X, Y)
 
     if K_XY_only:
         return K_XY
     
-    XXsqnorm = tf.maximum(-2. * XX + c(X_sqnorms) + r(X_sqnorms), 0.)
-    YYsqnorm = tf.maximum(-2. * YY + c(Y_sqnorms) + r(Y_sqnorms), 0.)
-    
-    for alpha, wt in zip(alphas, wts):
-        logXX = tf.log(1. + XXsqnorm/(2.*alpha))
-        logYY = tf.log(1. + YYsqnorm/(2.*alpha))
-        K_XX += wt * tf.exp(-alpha * logXX)
-        K_YY += wt * tf.exp(-alpha * logYY)
+    K_XX = _rq_mixture(gram.sqdist(X, X), consts, fused)
+    K_YY = _rq_mixture(gram.sqdist(Y, Y), consts, fused)
     if add_dot > 0:
-        K_XX += tf.cast(add_dot, tf.float32) * XX
-        K_YY += tf.cast(add_dot, tf.float32) * YY
+        K_XX += consts['add_dot'] * gram.dot(X, X)
+        K_YY += consts['add_dot'] * gram.dot(Y, Y)
 
-    # wts = tf.reduce_sum(tf.cast(wts, tf.float32))
-    wts = tf.reduce_sum(tf.cast(wts, tf.float32))
-    return K_XX, K_XY, K_YY, wts
+    return K_XX, K_XY, K_YY, consts['wts_sum']
 
 
-def mmd2(K, biased=False):
+def _random_features(X, Y, scales, wts, n_features, gram, key, add_dot=.0):
+    """
+    Random Fourier features of a mixture of shift-invariant kernels. The
+    frequencies of component c are drawn as N(0, I) * scales[c], with scales
+    of shape [n_features, no. of components]. They are sampled anew at every
+    session run and shared, through the Gram cache, by all evaluations of
+    the step.
+    """
+    d = int(X.get_shape()[1])
+    n_components = len(wts)
+    W = gram.memo(key, lambda: tf.reshape(
+        tf.random_normal([d, n_features, n_components]) * scales,
+        [d, n_features * n_components]))
+    col_scale = tf.sqrt(tf.tile(tf.constant(wts, dtype=tf.float32), [n_features]) / n_features)
+
+    def phi(Z):
+        ZW = tf.matmul(Z, W)
+        features = [tf.cos(ZW) * col_scale, tf.sin(ZW) * col_scale]
+        if add_dot > 0:
+            features.append(Z * tf.sqrt(tf.cast(add_dot, tf.float32)))
+        return tf.concat(features, 1)
+
+    phi_X = gram.memo((key, X), lambda: phi(X))
+    phi_Y = gram.memo((key, Y), lambda: phi(Y))
+    return phi_X, phi_Y
+
+
+def _rff_mix_rbf_kernel(X, Y, sigmas=[2.0, 5.0, 10.0, 20.0, 40.0, 80.0], wts=None,
+                        K_XY_only=False, gram=None, n_features=256):
+    """
+    Random Fourier feature approximation of the mix_rbf kernel, with
+    n_features frequencies per bandwidth.
+    """
+    if wts is None:
+        wts = [1.] * len(sigmas)
+    if gram is None:
+        gram = Gram()
+    scales = tf.constant([1. / sigma for sigma in sigmas], dtype=tf.float32)
+    phi_X, phi_Y = _random_features(X, Y, scales, wts, n_features, gram,
+                                    key=('rff_mix_rbf', tuple(sigmas), n_features))
+    if K_XY_only:
+        return tf.matmul(phi_X, phi_Y, transpose_b=True)
+    return FeatureKernel(phi_X, phi_Y)
+
+
+def _rff_mix_rq_kernel(X, Y, alphas=[.1, 1., 10.], wts=None, K_XY_only=False, add_dot=.0,
+                       gram=None, n_features=256):
+    """
+    Random Fourier feature approximation of the mix_rq kernel. The rational
+    quadratic kernel is a scale mixture of Gaussians,
+        (1 + r^2 / (2 alpha))^(-alpha) = E_t[exp(-t r^2 / 2)],  t ~ Gamma(alpha, rate=alpha),
+    so each frequency is drawn with its own precision t.
+    """
+    if wts is None:
+        wts = [1.] * len(alphas)
+    if gram is None:
+        gram = Gram()
+    key = ('rff_mix_rq', tuple(alphas), n_features)
+    precisions = gram.memo(key + ('precisions',), lambda: tf.random_gamma(
+        [n_features], alpha=alphas, beta=alphas, dtype=tf.float32))
+    phi_X, phi_Y = _random_features(X, Y, tf.sqrt(precisions), wts, n_features, gram,
+                                    key=key, add_dot=add_dot)
+    if K_XY_only:
+        return tf.matmul(phi_X, phi_Y, transpose_b=True)
+    return FeatureKernel(phi_X, phi_Y)
+
+
+_floats = lambda v: [float(x) for x in v.split(',')]
+_bool = lambda v: v.lower() in ['1', 'true', 'yes']
+
+# name: (kernel function, {spec option: (keyword argument, parser)}, constants builder)
+_MIX_RBF_OPTIONS = {'sigmas': ('sigmas', _floats), 'wts': ('wts', _floats)}
+_MIX_RQ_OPTIONS = {'alphas': ('alphas', _floats), 'wts': ('wts', _floats),
+                   'dot': ('add_dot', float)}
+_FUSED = {'fused': ('fused', _bool)}
+_FEATURES = {'features': ('n_features', int)}
+_PRECISION = {'precision': ('precision', str)}
+PRECISIONS = ['float32', 'float16', 'bfloat16']
+KERNELS = {
+    'mix_rbf': (_mix_rbf_kernel, dict(_MIX_RBF_OPTIONS, **dict(_FUSED, **_PRECISION)), _rbf_consts),
+    'mix_rq': (_mix_rq_kernel, dict(_MIX_RQ_OPTIONS, **dict(_FUSED, **_PRECISION)), _rq_consts),
+    'tanh_mix_rq': (_tanh_mix_rq_kernel, dict(_MIX_RQ_OPTIONS, **dict(_FUSED, **_PRECISION)), _rq_consts),
+    'distance': (_distance_kernel, dict(_PRECISION), None),
+    'tanh_distance': (_tanh_distance_kernel, dict(_PRECISION), None),
+    'dot': (_dot_kernel, dict(_PRECISION), None),
+    'rff_mix_rbf': (_rff_mix_rbf_kernel, dict(_MIX_RBF_OPTIONS, **_FEATURES), None),
+    'rff_mix_rq': (_rff_mix_rq_kernel, dict(_MIX_RQ_OPTIONS, **_FEATURES), None),
+}
+# names of the former _mix_rq_*dot_kernel functions
+KERNEL_ALIASES = {
+    'mix_rq_dot': 'mix_rq:dot=.1',
+    'mix_rq_1dot': 'mix_rq:dot=1',
+    'mix_rq_10dot': 'mix_rq:dot=10',
+    'mix_rq_01dot': 'mix_rq:dot=.1',
+    'mix_rq_001dot': 'mix_rq:dot=.01',
+}
+
+
+class Kernel(object):
+    """
+    Kernel with fixed parameters, as returned by get_kernel. Constant tensors
+    are built once per graph and the kernel graph is memoized per input pair,
+    so repeated evaluations on the same tensors do not add ops.
+    Called like the _*_kernel functions: kernel(X, Y, K_XY_only=False, gram=None).
+
+    With a reduced precision dtype (float16 or bfloat16) the inner products,
+    distances and exp/log are computed in that dtype and the kernel matrices
+    are cast back to float32, so that all the estimator sums still accumulate
+    in float32. See precision_error for a check against the float32 kernel.
+    """
+    def __init__(self, name, fn, kwargs, consts_builder=None, dtype=tf.float32):
+        self.name = name
+        self.fn = fn
+        self.kwargs = kwargs
+        self.consts_builder = consts_builder
+        self.dtype = dtype
+        self._cast = lambda Z: tf.cast(Z, dtype)
+        self._consts = {}
+        self._memo = {}
+
+    def consts(self):
+        graph = tf.get_default_graph()
+        if graph not in self._consts:
+            params = dict((k, v) for k, v in self.kwargs.items()
+                          if k in ['sigmas', 'alphas', 'wts', 'add_dot'])
+            self._consts[graph] = self.consts_builder(dtype=self.dtype, **params)
+        return self._consts[graph]
+
+    def __call__(self, X, Y, K_XY_only=False, gram=None):
+        key = (X, Y, K_XY_only, gram)
+        if key not in self._memo:
+            kwargs = dict(self.kwargs)
+            if self.consts_builder is not None:
+                kwargs['consts'] = self.consts()
+            if self.dtype == tf.float32:
+                self._memo[key] = self.fn(X, Y, K_XY_only=K_XY_only, gram=gram, **kwargs)
+            else:
+                self._memo[key] = self._reduced_precision(X, Y, K_XY_only, gram, kwargs)
+        return self._memo[key]
+
+    def _reduced_precision(self, X, Y, K_XY_only, gram, kwargs):
+        if gram is None:
+            gram = Gram()
+        K = self.fn(gram.map(self._cast, X), gram.map(self._cast, Y),
+                    K_XY_only=K_XY_only, gram=gram, **kwargs)
+        to_float32 = lambda t: t if (t is False) else tf.cast(t, tf.float32)
+        if K_XY_only:
+            return to_float32(K)
+        return tuple(to_float32(t) for t in K)
+
+    def precision_error(self, X, Y):
+        """
+        Deviation of the MMD^2 estimate from the one with the float32 kernel,
+        relative to the magnitude of the latter. Zero for float32 kernels.
+        """
+        if self.dtype == tf.float32:
+            return tf.constant(0.)
+        reference = Kernel(self.name, self.fn, self.kwargs, self.consts_builder)
+        mmd2_32 = mmd2(reference(X, Y))
+        return tf.abs(mmd2(self(X, Y)) - mmd2_32) / tf.maximum(tf.abs(mmd2_32), 1e-12)
+
+    def __repr__(self):
+        return 'Kernel(%s)' % self.name
+
+
+def get_kernel(spec, **defaults):
+    """
+    Parses a kernel spec 'name[:option=value[;option=value...]]', e.g.
+        mix_rbf:sigmas=2,5,10;fused=1
+        mix_rq:alphas=.1,1,10;wts=1,1,.5;dot=1;precision=float16
+    and returns a Kernel. List values are comma-separated. Keyword defaults
+    (e.g. fused=True, n_features=256, precision='float16') are used for the
+    options the kernel supports, unless overridden in the spec.
+    """
+    spec = KERNEL_ALIASES.get(spec, spec)
+    name, _, options = spec.partition(':')
+    if name not in KERNELS:
+        raise ValueError('unknown kernel %s, choose from %s' % (
+            repr(name), ', '.join(sorted(list(KERNELS) + list(KERNEL_ALIASES)))))
+    fn, parsers, consts_builder = KERNELS[name]
+    kw_names = [kw for kw, _ in parsers.values()]
+    kwargs = dict((k, v) for k, v in defaults.items() if k in kw_names)
+    for option in filter(None, options.split(';')):
+        key, eq, value = option.partition('=')
+        if (not eq) or (key not in parsers):
+            raise ValueError('invalid option %s for kernel %s, valid options: %s' % (
+                repr(option), name, ', '.join(sorted(parsers))))
+        kw, parse = parsers[key]
+        try:
+            kwargs[kw] = parse(value)
+        except ValueError:
+            raise ValueError('cannot parse %s=%s for kernel %s' % (key, value, name))
+
+    params = kwargs.get('sigmas', kwargs.get('alphas'))
+    if params is not None:
+        if min(params) <= 0:
+            raise ValueError('kernel %s: bandwidths must be positive' % name)
+        if ('wts' in kwargs) and (len(kwargs['wts']) != len(params)):
+            raise ValueError('kernel %s: %d weights for %d components' % (
+                name, len(kwargs['wts']), len(params)))
+    if kwargs.get('add_dot', 0) < 0:
+        raise ValueError('kernel %s: dot must be non-negative' % name)
+    if kwargs.get('n_features', 1) <= 0:
+        raise ValueError('kernel %s: features must be positive' % name)
+    precision = kwargs.pop('precision', 'float32')
+    if precision not in PRECISIONS:
+        raise ValueError('kernel %s: precision must be one of %s' % (name, ', '.join(PRECISIONS)))
+    return Kernel(spec, fn, kwargs, consts_builder, dtype=tf.as_dtype(precision))
+
+
+def to_blocks(X, Y, block_size):
+    """
+    Reshapes X and Y into [n_blocks, block_size, dim] batches, dropping the
+    remainder, for the 'block' and 'linear' estimators of mmd2.
+    """
+    n_blocks = min(int(X.get_shape()[0]), int(Y.get_shape()[0])) // block_size
+    assert n_blocks > 0, 'block size %d larger than the batch' % block_size
+    shape = lambda Z: [n_blocks, block_size] + Z.get_shape().as_list()[1:]
+    return (tf.reshape(X[:n_blocks * block_size], shape(X)),
+            tf.reshape(Y[:n_blocks * block_size], shape(Y)))
+
+
+def mmd2(K, biased=False, estimator='full'):
+    """
+    estimator: 'full' for the U- (or V-) statistic over all pairs,
+               'block' for the average of the statistics over blocks, with K
+                   computed on to_blocks(X, Y, block_size),
+               'linear' for the linear-time statistic, with K computed on
+                   to_blocks(X, Y, 2).
+    """
+    if isinstance(K, FeatureKernel):
+        if estimator != 'full':
+            raise ValueError('random feature kernels are already linear-time, '
+                             'use the full estimator')
+        m = tf.cast(K.phi_X.get_shape()[0], tf.float32)
+        n = tf.cast(K.phi_Y.get_shape()[0], tf.float32)
+        return _mmd2_from_sums(*K.sums(), m=m, n=n, biased=biased)
     K_XX, K_XY, K_YY, const_diagonal = K
+    if estimator == 'linear':
+        return _linear_mmd2(K_XX, K_XY, K_YY)
+    if estimator == 'block':
+        return tf.reduce_mean(_mmd2(K_XX, K_XY, K_YY, const_diagonal, biased))
+    if estimator != 'full':
+        raise ValueError('unknown MMD estimator: %s' % estimator)
     return _mmd2(K_XX, K_XY, K_YY, const_diagonal, biased) # numerics checked at _mmd2 return
     
 
 def _mmd2(K_XX, K_XY, K_YY, const_diagonal=False, biased=False):
-    m = tf.cast(K_XX.get_shape()[0], tf.float32)
-    n = tf.cast(K_YY.get_shape()[0], tf.float32)
+    # works on single kernel matrices as well as on batches of blocks
+    m = tf.cast(K_XX.get_shape()[-2], tf.float32)
+    n = tf.cast(K_YY.get_shape()[-2], tf.float32)
+    sum_ = lambda K: tf.reduce_sum(K, [-2, -1])
 
     if biased:
-        mmd2 = (tf.reduce_sum(K_XX) / (m * m)
-              + tf.reduce_sum(K_YY) / (n * n)
-              - 2 * tf.reduce_sum(K_XY) / (m * n))
+        mmd2 = (sum_(K_XX) / (m * m)
+              + sum_(K_YY) / (n * n)
+              - 2 * sum_(K_XY) / (m * n))
     else:
         if const_diagonal is not False:
             const_diagonal = tf.cast(const_diagonal, tf.float32)
@@ -177,14 +522,46 @@ def _mmd2(K_XX, K_XY, K_YY, const_diagonal=False, biased=False):
             trace_X = tf.trace(K_XX)
             trace_Y = tf.trace(K_YY)
 
-        mmd2 = ((tf.reduce_sum(K_XX) - trace_X) / (m * (m - 1))
-              + (tf.reduce_sum(K_YY) - trace_Y) / (n * (n - 1))
-              - 2 * tf.reduce_sum(K_XY) / (m * n))
+        mmd2 = ((sum_(K_XX) - trace_X) / (m * (m - 1))
+              + (sum_(K_YY) - trace_Y) / (n * (n - 1))
+              - 2 * sum_(K_XY) / (m * n))
 
     return mmd2 
 
 
+def _linear_mmd2(K_XX, K_XY, K_YY):
+    """
+    Linear-time MMD^2 estimator of Gretton et al. (2012), averaging
+    h = k(x, x') + k(y, y') - k(x, y') - k(x', y) over disjoint pairs.
+    """
+    assert K_XX.get_shape()[-1] == 2, 'linear estimator needs blocks of size 2'
+    h = K_XX[:, 0, 1] + K_YY[:, 0, 1] - K_XY[:, 0, 1] - K_XY[:, 1, 0]
+    return tf.reduce_mean(h)
+
+
+def _mmd2_from_sums(XX_sums, YY_sums, XY_sums, m, n, biased=False):
+    Kt_XX_sum = tf.reduce_sum(XX_sums[0])
+    Kt_YY_sum = tf.reduce_sum(YY_sums[0])
+    K_XY_sum = tf.reduce_sum(XY_sums[0])
+
+    if biased:
+        mmd2 = ((Kt_XX_sum + XX_sums[2]) / (m * m)
+              + (Kt_YY_sum + YY_sums[2]) / (n * n)
+              - 2 * K_XY_sum / (m * n))
+    else:
+        mmd2 = (Kt_XX_sum / (m * (m - 1))
+              + Kt_YY_sum / (n * (n - 1))
+              - 2 * K_XY_sum / (m * n))
+
+    return mmd2
+
+
 def mmd2_and_ratio(K, biased=False, min_var_est=_eps):
+    if isinstance(K, FeatureKernel):
+        m = tf.cast(K.phi_X.get_shape()[0], tf.float32)
+        mmd2, var_est = _mmd2_and_variance_from_sums(*K.sums(), m=m, biased=biased)
+        ratio = mmd2 / tf.sqrt(tf.maximum(var_est, min_var_est))
+        return mmd2, ratio, var_est
     K_XX, K_XY, K_YY, const_diagonal = K
     return _mmd2_and_ratio(K_XX, K_XY, K_YY, const_diagonal, biased, min_var_est)
     
@@ -222,14 +599,26 @@ def _mmd2_and_variance(K_XX, K_XY, K_YY, const_diagonal=False, biased=False):
     K_XY_sums_0 = tf.reduce_sum(K_XY, 0)
     K_XY_sums_1 = tf.reduce_sum(K_XY, 1)
 
-    Kt_XX_sum = tf.reduce_sum(Kt_XX_sums)
-    Kt_YY_sum = tf.reduce_sum(Kt_YY_sums)
-    K_XY_sum = tf.reduce_sum(K_XY_sums_0)
-
     Kt_XX_2_sum = sq_sum(K_XX) - sum_diag2_X
     Kt_YY_2_sum = sq_sum(K_YY) - sum_diag2_Y
     K_XY_2_sum  = sq_sum(K_XY)
 
+    return _mmd2_and_variance_from_sums(
+        (Kt_XX_sums, Kt_XX_2_sum, sum_diag_X),
+        (Kt_YY_sums, Kt_YY_2_sum, sum_diag_Y),
+        (K_XY_sums_0, K_XY_sums_1, K_XY_2_sum),
+        m, biased=biased)
+
+
+def _mmd2_and_variance_from_sums(XX_sums, YY_sums, XY_sums, m, biased=False):
+    Kt_XX_sums, Kt_XX_2_sum, sum_diag_X = XX_sums
+    Kt_YY_sums, Kt_YY_2_sum, sum_diag_Y = YY_sums
+    K_XY_sums_0, K_XY_sums_1, K_XY_2_sum = XY_sums
+
+    Kt_XX_sum = tf.reduce_sum(Kt_XX_sums)
+    Kt_YY_sum = tf.reduce_sum(Kt_YY_sums)
+    K_XY_sum = tf.reduce_sum(K_XY_sums_0)
+
     if biased:
         mmd2 = ((Kt_XX_sum + sum_diag_X) / (m * m)
               + (Kt_YY_sum + sum_diag_Y) / (m * m)
@@ -257,24 +646,203 @@ def _mmd2_and_variance(K_XX, K_XY, K_YY, const_diagonal=False, biased=False):
     return mmd2, var_est
 
 
+def _tiles(n, tile_size):
+    return [(start, min(start + tile_size, n)) for start in range(0, n, tile_size)]
+
+
+def _symmetric_sums(kernel, X, tile_size=512, gram=None):
+    """
+    Sums of K_XX used by the estimators: (Kt_XX_sums, Kt_XX_2_sum, sum_diag_X).
+    Only the tiles on and above the block diagonal are evaluated; the full
+    m x m matrix is never formed.
+    """
+    if gram is None:
+        gram = Gram()
+    blocks = [X[start:end] for start, end in _tiles(int(X.get_shape()[0]), tile_size)]
+    row_sums = [[] for _ in blocks]
+    sq_sums, diags = [], []
+    for i, X_i in enumerate(blocks):
+        K_ii = kernel(X_i, X_i, K_XY_only=True, gram=gram)
+        diag = tf.diag_part(K_ii)
+        diags.append(diag)
+        row_sums[i].append(tf.reduce_sum(K_ii, 1) - diag)
+        sq_sums.append(sq_sum(K_ii) - sq_sum(diag))
+        for j in range(i + 1, len(blocks)):
+            K_ij = kernel(X_i, blocks[j], K_XY_only=True, gram=gram)
+            row_sums[i].append(tf.reduce_sum(K_ij, 1))
+            row_sums[j].append(tf.reduce_sum(K_ij, 0))
+            sq_sums.append(2 * sq_sum(K_ij))
+    Kt_XX_sums = tf.concat([tf.add_n(sums) for sums in row_sums], 0)
+    return Kt_XX_sums, tf.add_n(sq_sums), tf.reduce_sum(tf.concat(diags, 0))
+
+
+def _cross_sums(kernel, X, Y, tile_size=512, gram=None):
+    """
+    Sums of K_XY used by the estimators: (K_XY_sums_0, K_XY_sums_1, K_XY_2_sum),
+    accumulated over tiles of size at most tile_size x tile_size.
+    """
+    if gram is None:
+        gram = Gram()
+    X_blocks = [X[start:end] for start, end in _tiles(int(X.get_shape()[0]), tile_size)]
+    Y_blocks = [Y[start:end] for start, end in _tiles(int(Y.get_shape()[0]), tile_size)]
+    sums_0 = [[] for _ in Y_blocks]
+    sums_1 = [[] for _ in X_blocks]
+    sq_sums = []
+    for i, X_i in enumerate(X_blocks):
+        for j, Y_j in enumerate(Y_blocks):
+            K_ij = kernel(X_i, Y_j, K_XY_only=True, gram=gram)
+            sums_0[j].append(tf.reduce_sum(K_ij, 0))
+            sums_1[i].append(tf.reduce_sum(K_ij, 1))
+            sq_sums.append(sq_sum(K_ij))
+    K_XY_sums_0 = tf.concat([tf.add_n(sums) for sums in sums_0], 0)
+    K_XY_sums_1 = tf.concat([tf.add_n(sums) for sums in sums_1], 0)
+    return K_XY_sums_0, K_XY_sums_1, tf.add_n(sq_sums)
+
+
+def _get_sums_tiled(kernel, X, Y, tile_size=512, gram=None):
+    """
+    Same statistics as _get_sums(K_XY, K_YY), computed from kernel tiles
+    without materializing K_XY or K_YY.
+    """
+    Kt_YY_sums, Kt_YY_2_sum, _ = _symmetric_sums(kernel, Y, tile_size, gram)
+    K_XY_sums_0, K_XY_sums_1, K_XY_2_sum = _cross_sums(kernel, X, Y, tile_size, gram)
+    return Kt_YY_sums, Kt_YY_2_sum, K_XY_sums_0, K_XY_sums_1, K_XY_2_sum
+
+
+def _zeros_if_none(grad, like):
+    return tf.zeros_like(like) if grad is None else grad
+
+
+def _tiled_sums_grad(kernel, X, Y, tile_size, grads, outputs, gram):
+    """
+    Gradients of the tiled sums w.r.t. X and Y. Every kernel tile is
+    recomputed and backpropagated on its own, so only O(tile_size^2) kernel
+    values are alive at a time. Uses k(x, y) = k(y, x). gram is the cache of
+    the forward pass, so that random feature kernels recompute the tiles with
+    the same frequencies.
+    """
+    (g_XX_rows, g_XX_sq, g_X_diag, g_YY_rows, g_YY_sq, g_Y_diag,
+     g_XY_0, g_XY_1, g_XY_sq) = [_zeros_if_none(g, o) for g, o in zip(grads, outputs)]
+
+    def symmetric(Z, g_rows, g_sq, g_diag):
+        tiles = _tiles(int(Z.get_shape()[0]), tile_size)
+        blocks = [Z[start:end] for start, end in tiles]
+        g_blocks = [g_rows[start:end] for start, end in tiles]
+        grads_Z = [[] for _ in blocks]
+        for i, Z_i in enumerate(blocks):
+            K_ii = kernel(Z_i, Z_i, K_XY_only=True, gram=gram)
+            eye = tf.eye(tf.shape(K_ii)[0])
+            G = (c(g_blocks[i]) + 2 * g_sq * K_ii) * (1. - eye) + g_diag * eye
+            grads_Z[i] += tf.gradients(K_ii, [Z_i], grad_ys=G)
+            for j in range(i + 1, len(blocks)):
+                K_ij = kernel(Z_i, blocks[j], K_XY_only=True, gram=gram)
+                G = c(g_blocks[i]) + r(g_blocks[j]) + 4 * g_sq * K_ij
+                g_i, g_j = tf.gradients(K_ij, [Z_i, blocks[j]], grad_ys=G)
+                grads_Z[i].append(g_i)
+                grads_Z[j].append(g_j)
+        return [tf.add_n(g) for g in grads_Z]
+
+    grads_X = symmetric(X, g_XX_rows, g_XX_sq, g_X_diag)
+    grads_Y = symmetric(Y, g_YY_rows, g_YY_sq, g_Y_diag)
+
+    X_tiles = _tiles(int(X.get_shape()[0]), tile_size)
+    Y_tiles = _tiles(int(Y.get_shape()[0]), tile_size)
+    for i, (x0, x1) in enumerate(X_tiles):
+        for j, (y0, y1) in enumerate(Y_tiles):
+            X_i, Y_j = X[x0:x1], Y[y0:y1]
+            K_ij = kernel(X_i, Y_j, K_XY_only=True, gram=gram)
+            G = c(g_XY_1[x0:x1]) + r(g_XY_0[y0:y1]) + 2 * g_XY_sq * K_ij
+            g_i, g_j = tf.gradients(K_ij, [X_i, Y_j], grad_ys=G)
+            grads_X[i] += g_i
+            grads_Y[j] += g_j
+
+    return tf.concat(grads_X, 0), tf.concat(grads_Y, 0)
+
+
+def _tiled_sums(kernel, X, Y, tile_size=512):
+    """
+    Statistics of K_XX, K_YY and K_XY accumulated over kernel tiles. If
+    tf.custom_gradient is available the backward pass recomputes the tiles,
+    keeping memory O(tile_size^2) instead of O(m^2) during backprop too.
+    """
+    gram = Gram()
+    def forward(X, Y):
+        return (_symmetric_sums(kernel, X, tile_size, gram)
+                + _symmetric_sums(kernel, Y, tile_size, gram)
+                + _cross_sums(kernel, X, Y, tile_size, gram))
+
+    if hasattr(tf, 'custom_gradient'):
+        @tf.custom_gradient
+        def sums(X, Y):
+            outputs = forward(X, Y)
+            def grad(*grads):
+                return _tiled_sums_grad(kernel, X, Y, tile_size, grads, outputs, gram)
+            return outputs, grad
+    else:
+        sums = forward
+
+    flat = sums(X, Y)
+    return tuple(flat[:3]), tuple(flat[3:6]), tuple(flat[6:])
+
+
+def mmd2_tiled(kernel, X, Y, tile_size=512, biased=False):
+    """
+    Same estimator as mmd2(kernel(X, Y)), evaluated tile by tile so that the
+    kernel matrices never have to fit in memory at once.
+    """
+    m = tf.cast(X.get_shape()[0], tf.float32)
+    n = tf.cast(Y.get_shape()[0], tf.float32)
+    return _mmd2_from_sums(*_tiled_sums(kernel, X, Y, tile_size), m=m, n=n, biased=biased)
+
+
+def mmd2_and_ratio_tiled(kernel, X, Y, tile_size=512, biased=False, min_var_est=_eps):
+    "Tiled counterpart of mmd2_and_ratio; assumes X, Y are same shape."
+    m = tf.cast(X.get_shape()[0], tf.float32)
+    mmd2, var_est = _mmd2_and_variance_from_sums(
+        *_tiled_sums(kernel, X, Y, tile_size), m=m, biased=biased)
+    ratio = mmd2 / tf.sqrt(tf.maximum(var_est, min_var_est))
+    return mmd2, ratio, var_est
+
+
+def _polynomial_kernel(X, Y, dim):
+    return (tf.matmul(X, Y, transpose_b=True) / dim + 1) ** 3
+
+
+def stack_sums(sums_list):
+    """
+    Stacks a list of saved sums, as returned by _get_sums, into a single
+    tuple of tensors with a leading axis indexing the saved samples.
+    """
+    return tuple(tf.stack(s) for s in zip(*sums_list))
+
+
 def diff_polynomial_mmd2_and_ratio(X, Y, Z):
     dim = tf.cast(X.get_shape()[1], tf.float32)
-    # TODO: could definitely do this faster
-    K_XY = (tf.matmul(X, Y, transpose_b=True) / dim + 1) ** 3
-    K_XZ = (tf.matmul(X, Z, transpose_b=True) / dim + 1) ** 3
-    K_YY = (tf.matmul(Y, Y, transpose_b=True) / dim + 1) ** 3
-    K_ZZ = (tf.matmul(Z, Z, transpose_b=True) / dim + 1) ** 3
+    K_XY = _polynomial_kernel(X, Y, dim)
+    K_XZ = _polynomial_kernel(X, Z, dim)
+    K_YY = _polynomial_kernel(Y, Y, dim)
+    K_ZZ = _polynomial_kernel(Z, Z, dim)
     return _diff_mmd2_and_ratio(K_XY, K_XZ, K_YY, K_ZZ, const_diagonal=False)
 
 
-def diff_polynomial_mmd2_and_ratio_with_saving(X, Y, saved_sums_for_Z):
+def diff_polynomial_mmd2_and_ratio_with_saving(X, Y, saved_sums_for_Z, tile_size=0):
+    """
+    saved_sums_for_Z may be the sums of a single Z sample or a stack of them
+    (see stack_sums); in the latter case the MMD differences and ratios
+    against all saved samples are returned as vectors.
+    If tile_size is positive, the sums are accumulated over kernel tiles
+    (see _get_sums_tiled) instead of forming K_XY and K_YY.
+    """
     dim = tf.cast(X.get_shape()[1], tf.float32)
-    # TODO: could definitely do this faster
-    K_XY = (tf.matmul(X, Y, transpose_b=True) / dim + 1) ** 3
-    K_YY = (tf.matmul(Y, Y, transpose_b=True) / dim + 1) ** 3
-    m = tf.cast(K_YY.get_shape()[0], tf.float32)
+    m = tf.cast(Y.get_shape()[0], tf.float32)
     
-    Y_related_sums = _get_sums(K_XY, K_YY)
+    if tile_size > 0:
+        kernel = lambda A, B, K_XY_only=True, gram=None: _polynomial_kernel(A, B, dim)
+        Y_related_sums = _get_sums_tiled(kernel, X, Y, tile_size)
+    else:
+        K_XY = _polynomial_kernel(X, Y, dim)
+        K_YY = _polynomial_kernel(Y, Y, dim)
+        Y_related_sums = _get_sums(K_XY, K_YY)
     
     mmd2_diff, ratio = _diff_mmd2_and_ratio_from_sums(Y_related_sums, saved_sums_for_Z, m)
     
@@ -296,12 +864,15 @@ def _diff_mmd2_and_ratio(K_XY, K_XZ, K_YY, K_ZZ, const_diagonal=False):
 def _diff_mmd2_and_ratio_from_sums(Y_related_sums, Z_related_sums, m, const_diagonal=False):
     Kt_YY_sums, Kt_YY_2_sum, K_XY_sums_0, K_XY_sums_1, K_XY_2_sum = Y_related_sums
     Kt_ZZ_sums, Kt_ZZ_2_sum, K_XZ_sums_0, K_XZ_sums_1, K_XZ_2_sum = Z_related_sums
+    # Z related sums may be stacked along a leading axis; reduce along the last one
+    dot = lambda a, b: tf.reduce_sum(a * b, -1)
+    sq_sum = lambda a: tf.reduce_sum(tf.square(a), -1)
     
-    Kt_YY_sum = tf.reduce_sum(Kt_YY_sums)
-    Kt_ZZ_sum = tf.reduce_sum(Kt_ZZ_sums)
+    Kt_YY_sum = tf.reduce_sum(Kt_YY_sums, -1)
+    Kt_ZZ_sum = tf.reduce_sum(Kt_ZZ_sums, -1)
     
-    K_XY_sum = tf.reduce_sum(K_XY_sums_0)
-    K_XZ_sum = tf.reduce_sum(K_XZ_sums_0)
+    K_XY_sum = tf.reduce_sum(K_XY_sums_0, -1)
+    K_XZ_sum = tf.reduce_sum(K_XZ_sums_0, -1)
 
     # TODO: turn these into dot products?
     # should figure out if that's faster or not on GPU / with theano...
@@ -390,11 +961,32 @@ def _get_sums(K_XY, K_YY, const_diagonal=False):
     return Kt_YY_sums, Kt_YY_2_sum, K_XY_sums_0, K_XY_sums_1, K_XY_2_sum
 
 
+def _np_polynomial_kernel(X, Y, dim):
+    # (<x, y> / dim + 1) ** 3, in place on the matmul output
+    K = np.dot(X, Y.transpose())
+    K /= dim
+    K += 1
+    K **= 3
+    return K
+
+
+def np_stack_sums(sums_list):
+    """
+    Stacks a list of saved sums, as returned by _np_get_sums, into a single
+    tuple of arrays with a leading axis indexing the saved samples.
+    """
+    return tuple(np.stack(s) for s in zip(*sums_list))
+
+
 def np_diff_polynomial_mmd2_and_ratio_with_saving(X, Y, saved_sums_for_Z):
+    """
+    saved_sums_for_Z may be the sums of a single Z sample or a stack of them
+    (see np_stack_sums); in the latter case the MMD differences and ratios
+    against all saved samples are returned as arrays, in one vectorized pass.
+    """
     dim = float(X.shape[1])
-    # TODO: could definitely do this faster
-    K_XY = (np.dot(X, Y.transpose()) / dim + 1) ** 3
-    K_YY = (np.dot(Y, Y.transpose()) / dim + 1) ** 3
+    K_XY = _np_polynomial_kernel(X, Y, dim)
+    K_YY = _np_polynomial_kernel(Y, Y, dim)
     m = float(K_YY.shape[0])
     
     Y_related_sums = _np_get_sums(K_XY, K_YY)
@@ -410,12 +1002,15 @@ def np_diff_polynomial_mmd2_and_ratio_with_saving(X, Y, saved_sums_for_Z):
 def _np_diff_mmd2_and_ratio_from_sums(Y_related_sums, Z_related_sums, m, const_diagonal=False):
     Kt_YY_sums, Kt_YY_2_sum, K_XY_sums_0, K_XY_sums_1, K_XY_2_sum = Y_related_sums
     Kt_ZZ_sums, Kt_ZZ_2_sum, K_XZ_sums_0, K_XZ_sums_1, K_XZ_2_sum = Z_related_sums
+    # Z related sums may be stacked along a leading axis; everything below
+    # broadcasts, with vectors reduced along the last axis
+    dot = lambda a, b: (a * b).sum(-1)
     
-    Kt_YY_sum = Kt_YY_sums.sum()
-    Kt_ZZ_sum = Kt_ZZ_sums.sum()
+    Kt_YY_sum = Kt_YY_sums.sum(-1)
+    Kt_ZZ_sum = Kt_ZZ_sums.sum(-1)
     
-    K_XY_sum = K_XY_sums_0.sum()
-    K_XZ_sum = K_XZ_sums_0.sum()
+    K_XY_sum = K_XY_sums_0.sum(-1)
+    K_XZ_sum = K_XZ_sums_0.sum(-1)
 
     # TODO: turn these into dot products?
     # should figure out if that's faster or not on GPU / with theano...
@@ -427,19 +1022,19 @@ def _np_diff_mmd2_and_ratio_from_sums(Y_related_sums, Z_related_sums, m, const_d
     muX_muY = K_XY_sum / (m * m)
     muX_muZ = K_XZ_sum / (m * m)
 
-    E_y_muY_sq = (np.dot(Kt_YY_sums, Kt_YY_sums) - Kt_YY_2_sum) / (m*(m-1)*(m-2))
-    E_z_muZ_sq = (np.dot(Kt_ZZ_sums, Kt_ZZ_sums) - Kt_ZZ_2_sum) / (m*(m-1)*(m-2))
+    E_y_muY_sq = (dot(Kt_YY_sums, Kt_YY_sums) - Kt_YY_2_sum) / (m*(m-1)*(m-2))
+    E_z_muZ_sq = (dot(Kt_ZZ_sums, Kt_ZZ_sums) - Kt_ZZ_2_sum) / (m*(m-1)*(m-2))
 
-    E_x_muY_sq = (np.dot(K_XY_sums_1, K_XY_sums_1) - K_XY_2_sum) / (m*m*(m-1))
-    E_x_muZ_sq = (np.dot(K_XZ_sums_1, K_XZ_sums_1) - K_XZ_2_sum) / (m*m*(m-1))
+    E_x_muY_sq = (dot(K_XY_sums_1, K_XY_sums_1) - K_XY_2_sum) / (m*m*(m-1))
+    E_x_muZ_sq = (dot(K_XZ_sums_1, K_XZ_sums_1) - K_XZ_2_sum) / (m*m*(m-1))
 
-    E_y_muX_sq = (np.dot(K_XY_sums_0, K_XY_sums_0) - K_XY_2_sum) / (m*m*(m-1))
-    E_z_muX_sq = (np.dot(K_XZ_sums_0, K_XZ_sums_0) - K_XZ_2_sum) / (m*m*(m-1))
+    E_y_muX_sq = (dot(K_XY_sums_0, K_XY_sums_0) - K_XY_2_sum) / (m*m*(m-1))
+    E_z_muX_sq = (dot(K_XZ_sums_0, K_XZ_sums_0) - K_XZ_2_sum) / (m*m*(m-1))
 
-    E_y_muY_y_muX = np.dot(Kt_YY_sums, K_XY_sums_0) / (m*m*(m-1))
-    E_z_muZ_z_muX = np.dot(Kt_ZZ_sums, K_XZ_sums_0) / (m*m*(m-1))
+    E_y_muY_y_muX = dot(Kt_YY_sums, K_XY_sums_0) / (m*m*(m-1))
+    E_z_muZ_z_muX = dot(Kt_ZZ_sums, K_XZ_sums_0) / (m*m*(m-1))
 
-    E_x_muY_x_muZ = np.dot(K_XY_sums_1, K_XZ_sums_1) / (m*m*m)
+    E_x_muY_x_muZ = dot(K_XY_sums_1, K_XZ_sums_1) / (m*m*m)
 
     E_kyy2 = Kt_YY_2_sum / (m * (m-1))
     E_kzz2 = Kt_ZZ_2_sum / (m * (m-1))
@@ -473,7 +1068,7 @@ def _np_diff_mmd2_and_ratio_from_sums(Y_related_sums, Z_related_sums, m, const_d
     )
     var_est = first_order + second_order
 
-    ratio = mmd2_diff / np.sqrt(max(var_est, _eps))
+    ratio = mmd2_diff / np.sqrt(np.maximum(var_est, _eps))
     return mmd2_diff, ratio
 
 
@@ -1,5 +1,5 @@
 from __future__ import division, print_function
-import os, sys, time, pprint, numpy as np
+import os, re, sys, time, pprint, glob, shutil, numpy as np
 from . import  mmd
 from .ops import safer_norm, tf
 from .architecture import get_networks
@@ -59,7 +59,7 @@ class MMD_GAN(object):
         self.description = ("%s%s_%s%s_%sd%d-%d-%d_%s_%s_%s" % (
                     self.dataset, arch,
                     self.config.architecture, discriminator_desc,
-                    self.config.kernel, self.config.dsteps,
+                    re.sub(r'[^\w.,=-]', '_', self.config.kernel), self.config.dsteps,
                     self.config.start_dsteps, self.config.gsteps, self.batch_size,
                     self.output_size, lr))
         
@@ -79,7 +79,8 @@ class MMD_GAN(object):
             sys.stdout = self.log_file
             sys.stderr = self.log_file
         if config.compute_scores:
-            self.scorer = scorer.Scorer(self.dataset, config.MMD_lr_scheduler, stdout=stdout)
+            Scorer = scorer.AsyncScorer if config.async_scoring else scorer.Scorer
+            self.scorer = Scorer(self.dataset, config.MMD_lr_scheduler, stdout=stdout)
         print('Execution start time: %s' % time.ctime())
         pprint.PrettyPrinter().pprint(self.config.__dict__['__flags'])
         self.build_model()
@@ -157,11 +158,36 @@ class MMD_GAN(object):
 
 
     def set_loss(self, G, images):
-        kernel = getattr(mmd, '_%s_kernel' % self.config.kernel)
-        kerGI = kernel(G, images)
+        if self.config.mmd_estimator not in ['full', 'block', 'linear']:
+            raise ValueError('unknown mmd_estimator %s, choose from full, block, linear'
+                             % repr(self.config.mmd_estimator))
+        if (self.config.mmd_tile_size > 0) and (self.config.mmd_estimator != 'full'):
+            # tiling only applies to the full estimator, block kernels are small already
+            raise ValueError('mmd_tile_size cannot be combined with the %s estimator'
+                             % self.config.mmd_estimator)
+        kernel = mmd.get_kernel(self.config.kernel, fused=self.config.fused_kernel,
+                                n_features=self.config.rff_features,
+                                precision=self.config.kernel_precision)
+        if kernel.dtype != tf.float32:
+            self.kernel_precision_error = kernel.precision_error(G, images)
+            tf.summary.scalar('kernel_precision_error', self.kernel_precision_error)
+        self.gram = mmd.Gram()
             
         with tf.variable_scope('loss'):
-            self.g_loss = mmd.mmd2(kerGI)
+            if self.config.mmd_estimator in ['block', 'linear']:
+                block_size = 2 if (self.config.mmd_estimator == 'linear') else self.config.mmd_block_size
+                G_blocks, images_blocks = mmd.to_blocks(G, images, block_size)
+                kerGI = kernel(G_blocks, images_blocks, gram=self.gram)
+                self.g_loss = mmd.mmd2(kerGI, estimator=self.config.mmd_estimator)
+            elif self.config.mmd_tile_size > 0:
+                if self.config.gradient_penalty > 0:
+                    # the witness function of the penalty needs dense bs x bs
+                    # kernels, which is what tiling is meant to avoid
+                    raise ValueError('mmd_tile_size cannot be combined with gradient_penalty > 0')
+                self.g_loss = mmd.mmd2_tiled(kernel, G, images, self.config.mmd_tile_size)
+            else:
+                kerGI = kernel(G, images, gram=self.gram)
+                self.g_loss = mmd.mmd2(kerGI)
             self.d_loss = -self.g_loss 
             self.optim_name = 'kernel_loss'
             
@@ -173,14 +199,18 @@ class MMD_GAN(object):
 
     def add_gradient_penalty(self, kernel, fake, real):
         bs = min([self.batch_size, self.real_batch_size])
-        real, fake = real[:bs], fake[:bs]
+        # slice only if needed, so that the Gram cache built for the loss is reused
+        if bs < self.real_batch_size:
+            real = real[:bs]
+        if bs < self.batch_size:
+            fake = fake[:bs]
         
         alpha = tf.random_uniform(shape=[bs, 1, 1, 1])
         real_data = self.images[:bs] # discirminator input level
         fake_data = self.G[:bs] # discriminator input level
         x_hat_data = (1. - alpha) * real_data + alpha * fake_data
         x_hat = self.discriminator(x_hat_data, bs)
-        Ekx = lambda yy: tf.reduce_mean(kernel(x_hat, yy, K_XY_only=True), axis=1)
+        Ekx = lambda yy: tf.reduce_mean(kernel(x_hat, yy, K_XY_only=True, gram=self.gram), axis=1)
         Ekxr, Ekxf = Ekx(real), Ekx(fake)
         witness = Ekxr - Ekxf
         gradients = tf.gradients(witness, [x_hat_data])[0]
@@ -201,15 +231,26 @@ class MMD_GAN(object):
         if self.config.L2_discriminator_penalty > 0:
             penalty = 0.0
             for _, layer in self.d_G_layers.items():
-                penalty += tf.reduce_mean(tf.reshape(tf.square(layer), [self.batch_size, -1]), axis=1)
+                penalty += self._mean_square(layer)
             for _, layer in self.d_images_layers.items():
-                penalty += tf.reduce_mean(tf.reshape(tf.square(layer), [self.batch_size, -1]), axis=1)
+                penalty += self._mean_square(layer)
             self.d_L2_penalty = self.config.L2_discriminator_penalty * tf.reduce_mean(penalty)
             self.d_loss += self.d_L2_penalty
             self.optim_name += ' (L2 dp %.6f)' % self.config.L2_discriminator_penalty
             self.optim_name = self.optim_name.replace(') (', ', ')
             tf.summary.scalar('L2_disc_penalty', self.d_L2_penalty)
             print('[*] L2 discriminator penalty added')
+
+
+    def _mean_square(self, layer):
+        if layer.get_shape().as_list()[0] != self.batch_size:
+            # real batches can differ in size from generated ones; the penalty
+            # is averaged anyway, so a scalar mean broadcasts against the rest
+            return tf.reduce_mean(tf.square(layer))
+        if (layer is self.d_G) or (layer is self.d_images):
+            # squared norms of the discriminator outputs are already in the Gram cache
+            return self.gram.sqnorms(layer) / int(layer.get_shape()[1])
+        return tf.reduce_mean(tf.reshape(tf.square(layer), [self.batch_size, -1]), axis=1)
         
         
     def set_grads(self):
@@ -284,6 +325,11 @@ class MMD_GAN(object):
                 self.timer(step, "%s, G: %.8f, D: %.8f" % (self.optim_name, g_loss, d_loss))
                 if self.config.L2_discriminator_penalty > 0:
                     print(' ' * 22 + ('Discriminator L2 penalty: %.8f' % self.sess.run(self.d_L2_penalty)))
+                if hasattr(self, 'kernel_precision_error'):
+                    err = self.sess.run(self.kernel_precision_error)
+                    print(' ' * 22 + ('MMD^2 relative error vs float32 kernel: %.2e' % err))
+                    if err > 1e-2:
+                        print('WARNING! Reduced precision kernel changes MMD^2 by %.2e relative to float32.' % err)
             if np.mod(step + 1, self.config.max_iteration//5) == 0:
                 if not self.config.MMD_lr_scheduler:
 #                    self.lr *= self.config.decay_rate
@@ -335,7 +381,12 @@ class MMD_GAN(object):
         Pipeline = get_pipeline(self.dataset, self.config.suffix)
         pipe = Pipeline(self.output_size, self.c_dim, self.real_batch_size, 
                         os.path.join(self.data_dir, self.dataset), 
-                        timer=self.timer, sample_dir=self.sample_dir)
+                        timer=self.timer, sample_dir=self.sample_dir,
+                        decode_workers=self.config.decode_workers,
+                        input_backend=self.config.input_backend,
+                        shuffle_buffer=self.config.shuffle_buffer,
+                        input_threads=self.config.input_threads)
+        self.pipeline = pipe
         self.images = pipe.connect()        
 
             
@@ -356,11 +407,25 @@ class MMD_GAN(object):
         coord.join(threads)
 
 
-    def save_checkpoint(self, step=None):
+    def save_checkpoint(self, step=None, weights=None):
+        """
+        Saves MMDGAN.model-<step>, or best.model if step is None.
+        weights: prefix of a checkpoint saved earlier with write_state=False
+            (see utils.scorer.AsyncScorer) to store as best.model instead of 
+            the current weights
+        """
         self._ensure_dirs('checkpoint')
         if step is None:
-            self.saver.save(self.sess,
-                            os.path.join(self.checkpoint_dir, "best.model"))
+            path = os.path.join(self.checkpoint_dir, "best.model")
+            if weights is None:
+                self.saver.save(self.sess, path)
+            else:
+                for f in glob.glob(weights + '.*'):
+                    shutil.copy(f, path + f[len(weights):])
+                # update the checkpoint index like saver.save does
+                tf.train.update_checkpoint_state(
+                    self.checkpoint_dir, path, 
+                    all_model_checkpoint_paths=self.saver.last_checkpoints + [path])
         else:
             self.saver.save(self.sess,
                             os.path.join(self.checkpoint_dir, "MMDGAN.model"),
@@ -373,6 +438,8 @@ class MMD_GAN(object):
         if ckpt and ckpt.model_checkpoint_path:
             ckpt_name = os.path.basename(ckpt.model_checkpoint_path)
             self.saver.restore(self.sess, os.path.join(self.checkpoint_dir, ckpt_name))
+            if hasattr(self, 'scorer'):
+                self.scorer.load_three_sample(self.checkpoint_dir)
             return True
         else:
             return False
@@ -5,7 +5,8 @@ Created on Thu Jan 11 14:11:46 2018
 
 @author: mikolajbinkowski
 """
-import os, time, lmdb, io
+import os, time, lmdb, io, threading
+from multiprocessing.pool import ThreadPool
 import numpy as np
 import tensorflow as tf
 from PIL import Image
@@ -14,7 +15,8 @@ import matplotlib.pyplot as plt
 from utils import misc
 
 class Pipeline:
-    def __init__(self, output_size, c_dim, batch_size, data_dir, **kwargs):
+    def __init__(self, output_size, c_dim, batch_size, data_dir, 
+                 input_backend='queue', shuffle_buffer=0, input_threads=16, **kwargs):
         self.output_size = output_size
         self.c_dim = c_dim
 
@@ -24,38 +26,117 @@ class Pipeline:
         self.read_count = 0
         self.data_dir = data_dir
         self.shape = [self.read_batch, self.output_size, self.output_size, self.c_dim]
+        assert input_backend in ['queue', 'tf.data'], 'invalid input backend: %s' % input_backend
+        self.input_backend = input_backend
+        self.shuffle_buffer = shuffle_buffer if shuffle_buffer > 0 else self.read_batch
+        self.input_threads = input_threads
     
     def _transform(self, x):
         return x
     
+    def preprocessing(self):
+        """
+        Parts of a compute_scores.CodesCache key that identify the images this
+        pipeline produces: class, geometry and the code turning records into
+        images. Subclasses add whatever else their images depend on.
+        """
+        return (self.__class__.__name__, self.output_size, self.c_dim, self._transform)
+    
+    def _dataset(self):
+        """
+        tf.data counterpart of single_sample: an endless dataset of single
+        images of shape self.shape[-3:], before _transform
+        """
+        raise NotImplementedError('%s has no tf.data input' % self.__class__.__name__)
+        
+    def _unbatch(self, chunks):
+        # chunks of self.shape images coming out of a py_func -> single images
+        def set_shape(x):
+            x.set_shape(self.shape)
+            return x
+        return chunks.map(set_shape).apply(tf.data.experimental.unbatch())
+    
     def connect(self):
+        if self.input_backend == 'tf.data':
+            return self._connect_dataset()
         assert hasattr(self, 'single_sample'), 'Pipeline needs to have single_sample defined before connecting'
         self.single_sample.set_shape(self.shape)
         ims = tf.train.shuffle_batch([self.single_sample], self.batch_size,
                                     capacity=self.read_batch,
                                     min_after_dequeue=self.read_batch//8,
-                                    num_threads=16,
+                                    num_threads=self.input_threads,
                                     enqueue_many=len(self.shape) == 4)
         return self._transform(ims)
     
+    def _connect_dataset(self):
+        with tf.device('/cpu:0'):
+            dataset = self._dataset().shuffle(self.shuffle_buffer)
+            dataset = dataset.batch(self.batch_size, drop_remainder=True)
+            dataset = dataset.map(self._transform, num_parallel_calls=self.input_threads)
+            # keep a couple of batches ready while the model runs on the last one
+            dataset = dataset.prefetch(2)
+            ims = dataset.make_one_shot_iterator().get_next()
+        ims.set_shape([self.batch_size, self.output_size, self.output_size, self.c_dim])
+        return ims
+    
 
 class LMDB(Pipeline):
-    def __init__(self, *args, **kwargs):
+    def __init__(self, *args, decode_workers=8, **kwargs):
         super(LMDB, self).__init__(*args, **kwargs)
         self.timer = kwargs.get('timer', None) 
-        self.keys = []
-        env = lmdb.open(self.data_dir, map_size=1099511627776, max_readers=100, readonly=True)
-        with env.begin() as txn:
-            cursor = txn.cursor()
-            while cursor.next():
-                self.keys.append(cursor.key())
-        env.close()
+        # PIL releases the GIL while decoding and resizing, so threads are
+        # enough to decode a chunk in parallel
+        self.decode_pool = ThreadPool(decode_workers) if decode_workers > 1 else None
+        # one environment for the whole process (lmdb does not allow opening
+        # it twice); every reader thread keeps its own read-only transaction
+        # and cursor on it, see _cursor
+        self.env = lmdb.open(self.data_dir, map_size=1099511627776, max_readers=100, 
+                             readonly=True, lock=False)
+        self._local = threading.local()
+        with self.env.begin() as txn:
+            self.keys = list(txn.cursor().iternext(keys=True, values=False))
         print('No. of records in lmdb database: %d' % len(self.keys))
-        # tf queue for getting keys
-        key_producer = tf.train.string_input_producer(self.keys, shuffle=True)
-        single_key = key_producer.dequeue()
-        self.single_sample = tf.py_func(self._get_sample_from_lmdb, [single_key], tf.float32)
+        if self.input_backend == 'queue':
+            # tf queue for getting keys
+            key_producer = tf.train.string_input_producer(self.keys, shuffle=True)
+            single_key = key_producer.dequeue()
+            self.single_sample = tf.py_func(self._get_sample_from_lmdb, [single_key], tf.float32)
+        
+    def preprocessing(self):
+        return super(LMDB, self).preprocessing() + (self._decode, misc.center_and_scale)
+        
+    def _dataset(self):
+        keys = tf.data.Dataset.from_tensor_slices(self.keys).shuffle(len(self.keys)).repeat()
+        chunks = keys.map(lambda key: tf.py_func(self._get_sample_from_lmdb, [key], tf.float32),
+                          num_parallel_calls=self.input_threads)
+        return self._unbatch(chunks)
         
+    def _cursor(self, reset=False):
+        local = self._local
+        if reset and (getattr(local, 'txn', None) is not None):
+            local.txn.abort()
+            local.txn = None
+        if getattr(local, 'txn', None) is None:
+            # values are zero-copy buffers, valid until the cursor moves
+            local.txn = self.env.begin(write=False, buffers=True)
+            local.cursor = local.txn.cursor()
+        return local.cursor
+        
+    def _decode(self, raw):
+        try:
+            return misc.center_and_scale(Image.open(io.BytesIO(raw)), size=self.output_size)
+        except Exception as e:
+            return e
+
+    def _read_raw(self, cursor, n):
+        # copies out n records, so that they outlive the cursor's buffers
+        keys, raws = [], []
+        while len(raws) < n:
+            keys.append(bytes(cursor.key()))
+            raws.append(bytes(cursor.value()))
+            if not cursor.next():
+                cursor.first()
+        return keys, raws
         
     def _get_sample_from_lmdb(self, key, limit=None):
         if limit is None:
@@ -66,30 +147,39 @@ class LMDB(Pipeline):
             tt = time.time()
             self.timer(rc, 'lmdb: start reading chunk from database')
             ims = []
-            db_count = 1
+            n_errors = 0
+            cursor = self._cursor()
+            cursor.set_key(key)
+            if not cursor.next():
+                cursor.first()
             while len(ims) < limit:
-                env = lmdb.open(self.data_dir, map_size=1099511627776, max_readers=100, readonly=True)
-                with env.begin(write=False) as txn:
-                    cursor = txn.cursor()
+                try:
+                    keys, raws = self._read_raw(cursor, limit - len(ims))
+                except lmdb.Error as e:
+                    n_errors += 1
+                    self.timer(rc, 'lmdb error, renewing transaction (%d so far): %s' % (n_errors, str(e)))
+                    if n_errors > limit:
+                        raise
+                    cursor = self._cursor(reset=True)
                     cursor.set_key(key)
                     if not cursor.next():
                         cursor.first()
-                    db_err = False
-                    while (len(ims) < limit) and (not db_err):
-                        try:
-                            key, byte_arr = cursor.item()
-                            byte_im = io.BytesIO(byte_arr)
-                        #   byte_im.seek(0)
-                            im = Image.open(byte_im)
-                            ims.append(misc.center_and_scale(im, size=self.output_size))
-                        except Exception as e:
-                            self.timer(rc, 'lmdb error: ' + str(e))
-                            self.timer(rc, 'lmdb open no. %d failed at key %s, with %d collected images' % (db_count, repr(key), len(ims)))
-                            db_count += 1
-                            db_err = True
-                        if not cursor.next():
-                            cursor.first()
-                env.close()
+                    continue
+                key = keys[-1]
+                if self.decode_pool is None:
+                    decoded = [self._decode(raw) for raw in raws]
+                else:
+                    decoded = self.decode_pool.map(self._decode, raws)
+                for k, im in zip(keys, decoded):
+                    if isinstance(im, Exception):
+                        # skip the record and carry on with the next one
+                        n_errors += 1
+                        self.timer(rc, 'lmdb error at key %s, skipped (%d so far, %d collected images): %s' % (
+                            repr(k), n_errors, len(ims), str(im)))
+                        if n_errors > limit:
+                            raise im
+                    else:
+                        ims.append(im)
             self.timer(rc, 'lmdb read time = %f' % (time.time() - tt))
             return np.asarray(ims, dtype=np.float32)       
      
@@ -99,20 +189,100 @@ class LMDB(Pipeline):
         return self._get_sample_from_lmdb(choice, limit=size)
 
 
+class ArrayPipeline(Pipeline):
+    """
+    Base for datasets held as a uint8 array, in memory or memory-mapped, of
+    shape [N, output_size, output_size, c_dim]. The array stays out of the
+    graph: a py_func hands out chunks of read_batch images following random
+    permutations of the dataset, and images are only converted to float
+    batch by batch, in _transform.
+    """
+    def _set_data(self, data):
+        assert data.dtype == np.uint8
+        assert len(data) >= self.read_batch, 'dataset smaller than a read batch'
+        self.data = data
+        self._lock = threading.Lock()
+        self._order, self._pos = np.random.permutation(len(self.data)), 0
+        if self.input_backend == 'queue':
+            self.single_sample = tf.py_func(self._get_chunk, [], tf.uint8)
+        
+    def _dataset(self):
+        chunks = tf.data.Dataset.from_tensors(0).repeat().map(
+            lambda _: tf.py_func(self._get_chunk, [], tf.uint8),
+            num_parallel_calls=self.input_threads)
+        return self._unbatch(chunks)
+        
+    def _get_chunk(self):
+        with self._lock:  # epochs of random permutations, shared by all threads
+            if self._pos + self.read_batch > len(self._order):
+                self._order, self._pos = np.random.permutation(len(self.data)), 0
+            idx = self._order[self._pos:self._pos + self.read_batch]
+            self._pos += self.read_batch
+        # sorted indices read memory-mapped files front to back
+        return self.data[np.sort(idx)]
+    
+    def _transform(self, x):
+        return tf.cast(x, tf.float32)/255.
+
+
+class Memmap(ArrayPipeline):
+    """
+    Reads a dataset pre-decoded by make_memmap.py, a uint8 .npy file next to
+    the dataset directory.
+    """
+    def __init__(self, *args, **kwargs):
+        super(Memmap, self).__init__(*args, **kwargs)
+        self.path = path = memmap_path(self.data_dir, self.output_size)
+        data = np.load(path, mmap_mode='r')
+        assert data.shape[1:] == (self.output_size, self.output_size, self.c_dim), \
+            'memmap %s has images of shape %s' % (path, repr(data.shape[1:]))
+        print('No. of images in memmap: %d' % len(data))
+        self._set_data(data)
+        
+    def preprocessing(self):
+        # the images were decoded by make_memmap.py; converting again changes the file
+        st = os.stat(self.path)
+        return super(Memmap, self).preprocessing() + (self.path, st.st_size, st.st_mtime)
+
+
+def memmap_path(data_dir, output_size):
+    return '%s-%d.npy' % (data_dir.rstrip('/'), output_size)
+
+
 class TfRecords(Pipeline):
-    def __init__(self, *args, **kwargs):  
+    def __init__(self, *args, **kwargs):
+        super(TfRecords, self).__init__(*args, **kwargs)
         regex = os.path.join(self.data_dir, 'lsun-%d/bedroom_train_*' % self.output_size)
-        filename_queue = tf.train.string_input_producer(tf.gfile.Glob(regex), num_epochs=None)
-        reader = tf.TFRecordReader()
-        _, serialized_example = reader.read(filename_queue)
+        self.files = tf.gfile.Glob(regex)
+        self.shape = [self.output_size, self.output_size, self.c_dim]
+        if self.input_backend == 'queue':
+            filename_queue = tf.train.string_input_producer(self.files, num_epochs=None)
+            reader = tf.TFRecordReader()
+            _, serialized_example = reader.read(filename_queue)
+            self.single_sample = self._parse(serialized_example)
+        
+    def preprocessing(self):
+        return super(TfRecords, self).preprocessing() + (self._parse,)
+        
+    def _parse(self, serialized_example):
         features = tf.parse_single_example(serialized_example, features={
             'image/class/label': tf.FixedLenFeature([1], tf.int64),
             'image/encoded': tf.FixedLenFeature([], tf.string),
         })
-        image = tf.image.decode_jpeg(features['image/encoded'])
-        
-        self.single_sample = tf.cast(image, tf.float32)/255.
-        self.shape = [self.output_size, self.output_size, self.c_dim]
+        image = tf.image.decode_jpeg(features['image/encoded'], channels=self.c_dim)
+        image.set_shape(self.shape)
+        return image
+    
+    def _dataset(self):
+        files = tf.data.Dataset.from_tensor_slices(self.files).shuffle(len(self.files)).repeat()
+        # read several shards at once, so that consecutive records come from different files
+        cycle_length = min(len(self.files), self.input_threads)
+        records = files.interleave(tf.data.TFRecordDataset, cycle_length=cycle_length,
+                                   num_parallel_calls=cycle_length)
+        return records.map(self._parse, num_parallel_calls=self.input_threads)
+    
+    def _transform(self, x):
+        return tf.cast(x, tf.float32)/255.
 
 
 class JPEG(Pipeline):
@@ -120,31 +290,45 @@ class JPEG(Pipeline):
         super(JPEG, self).__init__(*args, **kwargs)
         #base_size = kwargs.get('base_size', 160)
         #random_crop = kwargs.get('random_crop', 9)
-        files = glob(os.path.join(self.data_dir, '*.jpg'))
-
-        filename_queue = tf.train.string_input_producer(files, shuffle=True)
-        reader = tf.WholeFileReader()
-        _, raw = reader.read(filename_queue)
+        self.files = glob(os.path.join(self.data_dir, '*.jpg'))
+        self.base_size, self.random_crop = base_size, random_crop
+        self.shape = [base_size, base_size, self.c_dim]    
+        
+        if self.input_backend == 'queue':
+            filename_queue = tf.train.string_input_producer(self.files, shuffle=True)
+            reader = tf.WholeFileReader()
+            _, raw = reader.read(filename_queue)
+            self.single_sample = self._decode(raw)
+        
+    def preprocessing(self):
+        return super(JPEG, self).preprocessing() + (self.base_size, self.random_crop, self._decode)
+        
+    def _decode(self, raw):
+        base_size, random_crop = self.base_size, self.random_crop
         decoded = tf.image.decode_jpeg(raw, channels=self.c_dim) # HWC
         bs = base_size + 2 * random_crop
         cropped = tf.image.resize_image_with_crop_or_pad(decoded, bs, bs)
         if random_crop > 0:
             cropped = tf.image.random_flip_left_right(cropped)
             cropped = tf.random_crop(cropped, [base_size, base_size, self.c_dim])
-        self.single_sample = cropped
-        self.shape = [base_size, base_size, self.c_dim]    
+        return cropped
+    
+    def _dataset(self):
+        files = tf.data.Dataset.from_tensor_slices(self.files).shuffle(len(self.files)).repeat()
+        return files.map(lambda f: self._decode(tf.read_file(f)), 
+                         num_parallel_calls=self.input_threads)
         
     def _transform(self, x):
         x = tf.image.resize_bilinear(x, (self.output_size, self.output_size))
         return tf.cast(x, tf.float32)/255.
 
 
-class Mnist(Pipeline):
+class Mnist(ArrayPipeline):
     def __init__(self, *args, **kwargs):
         super(Mnist, self).__init__(*args, **kwargs)
         fd = open(os.path.join(self.data_dir,'train-images-idx3-ubyte'))
         loaded = np.fromfile(file=fd,dtype=np.uint8)
-        trX = loaded[16:].reshape((60000,28,28,1)).astype(np.float)
+        trX = loaded[16:].reshape((60000,28,28,1))
     
         fd = open(os.path.join(self.data_dir,'train-labels-idx1-ubyte'))
         loaded = np.fromfile(file=fd,dtype=np.uint8)
@@ -152,7 +336,7 @@ class Mnist(Pipeline):
     
         fd = open(os.path.join(self.data_dir,'t10k-images-idx3-ubyte'))
         loaded = np.fromfile(file=fd,dtype=np.uint8)
-        teX = loaded[16:].reshape((10000,28,28,1)).astype(np.float)
+        teX = loaded[16:].reshape((10000,28,28,1))
     
         fd = open(os.path.join(self.data_dir,'t10k-labels-idx1-ubyte'))
         loaded = np.fromfile(file=fd,dtype=np.uint8)
@@ -161,18 +345,17 @@ class Mnist(Pipeline):
         trY = np.asarray(trY)
         teY = np.asarray(teY)
     
-        X = np.concatenate((trX, teX), axis=0).astype(np.float32) / 255.
+        X = np.concatenate((trX, teX), axis=0)
         y = np.concatenate((trY, teY), axis=0)
     
         seed = 547
         np.random.seed(seed)
         np.random.shuffle(X)
     
-        queue = tf.train.input_producer(tf.constant(X), shuffle=False)
-        self.single_sample = queue.dequeue_many(self.read_batch)
+        self._set_data(X)
 
 
-class Cifar10(Pipeline):
+class Cifar10(ArrayPipeline):
     def __init__(self, *args, **kwargs):
         super(Cifar10, self).__init__(*args, **kwargs)
         categories = np.arange(10)
@@ -190,15 +373,14 @@ class Cifar10(Pipeline):
         teX = test['data'][idx].reshape(idx.sum(), 3, 32, 32).transpose(0, 2, 3, 1)
         teY = np.array(test['labels'])[idx]
     
-        X = np.concatenate((trX, teX), axis=0).astype(np.float32) / 255.
+        X = np.concatenate((trX, teX), axis=0)
         y = np.concatenate((trY, teY), axis=0)
     
         seed = 547
         np.random.seed(seed)
         np.random.shuffle(X)
 
-        queue = tf.train.input_producer(tf.constant(X), shuffle=False)
-        self.single_sample = queue.dequeue_many(self.read_batch)
+        self._set_data(X)
         
 
 class GaussianMix(Pipeline):
@@ -232,8 +414,13 @@ class GaussianMix(Pipeline):
                         'ax1': ax1,
                         'writer': wrtr,
                         'figure': ax1.figure}
-        queue = tf.train.input_producer(tf.constant(X_real.astype(np.float32)), shuffle=False)
-        self.single_sample = queue.dequeue_many(self.read_batch)
+        self.X_real = X_real.astype(np.float32)
+        if self.input_backend == 'queue':
+            queue = tf.train.input_producer(tf.constant(self.X_real), shuffle=False)
+            self.single_sample = queue.dequeue_many(self.read_batch)
+            
+    def _dataset(self):
+        return tf.data.Dataset.from_tensor_slices(self.X_real).repeat()
 
         
 def myhist(X, ax=plt, bins='auto', **kwargs):
@@ -247,6 +434,8 @@ def myhist(X, ax=plt, bins='auto', **kwargs):
 
 
 def get_pipeline(dataset, info):
+    if 'memmap' in info:
+        return Memmap
     if 'lsun' in dataset:
         if 'tf_records' in info:
             return TfRecords
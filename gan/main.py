@@ -25,7 +25,13 @@ flags.DEFINE_string("sample_dir", "samples_mmd", "Directory name to save the ima
 flags.DEFINE_string("log_dir", "logs_mmd", "Directory name to save the image samples [logs_mmd]")
 flags.DEFINE_string("data_dir", "./data", "Directory containing datasets [./data]")
 flags.DEFINE_string("architecture", "dcgan", "The name of the architecture [dcgan, g-resnet5, dcgan5]")
-flags.DEFINE_string("kernel", "", "The name of the architecture ['', 'mix_rbf', 'mix_rq', 'distance', 'dot', 'mix_rq_dot']")
+flags.DEFINE_string("kernel", "", "Kernel spec, name[:option=value;...], e.g. 'mix_rq:alphas=.1,1,10;dot=1' ['', 'mix_rbf', 'mix_rq', 'distance', 'dot', 'mix_rq_dot', 'mix_rq_1dot', 'rff_mix_rbf', 'rff_mix_rq']")
+flags.DEFINE_integer("rff_features", 256, "Random Fourier frequencies per bandwidth for the rff_* kernels [256]")
+flags.DEFINE_boolean("fused_kernel", False, "Evaluate all bandwidths of mix_rbf/mix_rq kernels in a single broadcasted op [False]")
+flags.DEFINE_string("kernel_precision", "float32", "Precision of kernel matrices; sums are always accumulated in float32 [float32, float16, bfloat16]")
+flags.DEFINE_string("mmd_estimator", "full", "MMD estimator used in the loss [full, block, linear]")
+flags.DEFINE_integer("mmd_block_size", 64, "Block size for the block MMD estimator [64]")
+flags.DEFINE_integer("mmd_tile_size", 0, "If positive, evaluate the MMD loss in kernel tiles of this size, for large batches; only with the full estimator, not with gradient_penalty [0]")
 flags.DEFINE_string("model", "mmd", "The model type [mmd, cramer, wgan_gp]")
 flags.DEFINE_boolean("is_train", True, "True for training, False for testing [Train]")
 flags.DEFINE_boolean("visualize", False, "True for visualizing, False for nothing [False]")
@@ -40,8 +46,13 @@ flags.DEFINE_integer("dof_dim", 16, "No of discriminator output features [16]")
 flags.DEFINE_integer("gf_dim", 64, "no of generator channels [64]")
 flags.DEFINE_boolean("batch_norm", True, "Use of batch norm [False] (always False for discriminator if gradient_penalty > 0)")
 flags.DEFINE_boolean("log", True, "Wheather to write log to a file in samples directory [True]")
-flags.DEFINE_string("suffix", '', "For additional settings ['', '_tf_records']")
+flags.DEFINE_string("suffix", '', "For additional settings ['', '_tf_records', '_memmap' (see make_memmap.py)]")
+flags.DEFINE_integer("decode_workers", 8, "Threads decoding images of each LMDB chunk in parallel [8]")
+flags.DEFINE_string("input_backend", 'queue', "Input pipeline: tf.train queue runners or tf.data ['queue', 'tf.data']")
+flags.DEFINE_integer("shuffle_buffer", 0, "Images in the tf.data shuffle buffer, 0 for the read chunk size [0]")
+flags.DEFINE_integer("input_threads", 16, "Queue runner threads, or parallel calls of each tf.data map [16]")
 flags.DEFINE_boolean('compute_scores', False, "Compute scores [True]")
+flags.DEFINE_boolean('async_scoring', False, "Compute scores in a separate worker process (score_worker.py) while training continues [False]")
 flags.DEFINE_float("gpu_mem", .9, "GPU memory fraction limit [0.9]")
 flags.DEFINE_float("L2_discriminator_penalty", 0.0, "L2 penalty on discriminator features [0.0]")
 flags.DEFINE_integer("no_of_samples", 100000, "number of samples to produce")
@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Decodes a dataset once into a uint8 memmap for the '_memmap' pipeline
+(core.pipeline.Memmap), stored as [N, output_size, output_size, 3] in
+<data_dir>/<dataset>-<output_size>.npy. Images are framed like the pipeline
+they replace, but deterministically: 
+    lsun*   as misc.center_and_scale (LMDB pipeline): thumbnail to a shorter
+            side of output_size, then a center crop instead of a random one
+    celebA  as the JPEG pipeline: crop or pad to base_size + 2 * random_crop, 
+            a center base_size crop instead of a random crop and flip, then 
+            a bilinear resize to output_size
+The random crop and flip augmentation is dropped, and resized celebA images
+are rounded to uint8.
+
+    python make_memmap.py --dataset lsun --output_size 64
+"""
+from __future__ import division, print_function
+
+import io, os, sys
+from glob import glob
+from multiprocessing.pool import ThreadPool
+import numpy as np
+from PIL import Image
+from core.pipeline import memmap_path
+
+
+def center_crop(arr, size):
+    l0 = (arr.shape[0] - size) // 2
+    l1 = (arr.shape[1] - size) // 2
+    return arr[l0:l0 + size, l1:l1 + size]
+
+
+def crop_or_pad(arr, size):
+    # tf.image.resize_image_with_crop_or_pad
+    out = np.zeros((size, size) + arr.shape[2:], dtype=arr.dtype)
+    h, w = min(size, arr.shape[0]), min(size, arr.shape[1])
+    p0, p1 = max((size - arr.shape[0]) // 2, 0), max((size - arr.shape[1]) // 2, 0)
+    c0, c1 = max((arr.shape[0] - size) // 2, 0), max((arr.shape[1] - size) // 2, 0)
+    out[p0:p0 + h, p1:p1 + w] = arr[c0:c0 + h, c1:c1 + w]
+    return out
+
+
+def resize_bilinear(arr, size):
+    # tf.image.resize_bilinear with align_corners=False, as in TF 1.x
+    def grid(n):
+        x = np.arange(size) * (n / size)
+        x0 = np.floor(x).astype(np.int64)
+        return x0, np.minimum(x0 + 1, n - 1), (x - x0).astype(np.float32)
+    y0, y1, wy = grid(arr.shape[0])
+    x0, x1, wx = grid(arr.shape[1])
+    arr = arr.astype(np.float32)
+    wx = wx[:, None]
+    top = arr[y0][:, x0] * (1 - wx) + arr[y0][:, x1] * wx
+    bottom = arr[y1][:, x0] * (1 - wx) + arr[y1][:, x1] * wx
+    out = top + (bottom - top) * wy[:, None, None]
+    return np.clip(np.round(out), 0, 255).astype(np.uint8)
+
+
+def frame_lsun(im, size):
+    scale = min(im.size) / float(size)
+    im.thumbnail(tuple(np.array(im.size) / scale))
+    return center_crop(np.asarray(im, dtype=np.uint8), size)
+
+
+def frame_celebA(im, size, base_size=160, random_crop=9):
+    # defaults of core.pipeline.JPEG
+    arr = crop_or_pad(np.asarray(im, dtype=np.uint8), base_size + 2 * random_crop)
+    return resize_bilinear(center_crop(arr, base_size), size)
+
+
+def decode(raw, size, frame):
+    try:
+        arr = frame(Image.open(io.BytesIO(raw)).convert('RGB'), size)
+        assert arr.shape == (size, size, 3), 'shape error: %s' % repr(arr.shape)
+        return arr
+    except Exception as e:
+        print('Skipping undecodable image: %s' % str(e))
+        return None
+
+
+def lmdb_records(path):
+    # yields the number of records first, then the records
+    import lmdb
+    env = lmdb.open(path, map_size=1099511627776, readonly=True, lock=False)
+    with env.begin() as txn:
+        yield txn.stat()['entries']
+        for _, raw in txn.cursor():
+            yield raw
+    env.close()
+
+
+def jpeg_records(path):
+    files = sorted(glob(os.path.join(path, '*.jpg')))
+    yield len(files)
+    for f in files:
+        with open(f, 'rb') as fd:
+            yield fd.read()
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dataset', required=True, help='lsun* (lmdb) or celebA (jpg files)')
+    parser.add_argument('--data_dir', default='./data')
+    parser.add_argument('--output_size', type=int, default=64)
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--chunk_size', type=int, default=1024)
+    args = parser.parse_args()
+
+    source = os.path.join(args.data_dir, args.dataset)
+    path = memmap_path(source, args.output_size)
+    if os.path.exists(path):
+        sys.exit('%s already exists' % path)
+    if 'lsun' in args.dataset:
+        records, frame = lmdb_records(source), frame_lsun
+    else:
+        records, frame = jpeg_records(source), frame_celebA
+    n = next(records)
+    size = args.output_size
+    print('[ ] Converting %d images from %s to %s' % (n, source, path))
+
+    tmp = path + '.tmp'
+    out = np.lib.format.open_memmap(tmp, mode='w+', dtype=np.uint8, shape=(n, size, size, 3))
+    pool = ThreadPool(args.workers)
+    def write(chunk, count):
+        for arr in pool.map(lambda r: decode(r, size, frame), chunk):
+            if arr is not None:
+                out[count] = arr
+                count += 1
+        return count
+
+    count, done = 0, 0
+    chunk = []
+    for raw in records:
+        chunk.append(raw)
+        if len(chunk) == args.chunk_size:
+            count = write(chunk, count)
+            done += len(chunk)
+            chunk = []
+            print('\r%d / %d' % (done, n), end='')
+    count = write(chunk, count)
+    print()
+    out.flush()
+    del out
+    
+    if count < n:  # drop the slots of skipped images
+        full = np.load(tmp, mmap_mode='r')
+        out = np.lib.format.open_memmap(path + '.tmp2', mode='w+', dtype=np.uint8, 
+                                        shape=(count, size, size, 3))
+        for start in range(0, count, args.chunk_size):
+            out[start:start + args.chunk_size] = full[start:start + args.chunk_size]
+        out.flush()
+        del out, full
+        os.rename(path + '.tmp2', tmp)
+    os.rename(tmp, path)
+    print('[*] %d images saved in %s' % (count, path))
+
+
+if __name__ == '__main__':
+    main()
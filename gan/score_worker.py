@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Scoring worker for training with --async_scoring, see utils.scorer.AsyncScorer.
+Scores the samples spooled by training and writes back the decisions of the
+learning rate scheduler.
+"""
+from __future__ import division, print_function
+
+import os, re, sys, time, json
+import numpy as np
+import tensorflow as tf
+from utils import scorer, timer
+
+
+def parent_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError:
+        return False
+    return True
+
+
+def spooled_steps(spool_dir):
+    steps = []
+    for name in os.listdir(spool_dir):
+        match = re.match(r'^samples(\d+)\.npy$', name)
+        if match:
+            steps.append(int(match.group(1)))
+    return sorted(steps)
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dataset', required=True)
+    parser.add_argument('--spool_dir', required=True)
+    parser.add_argument('--sample_dir', required=True)
+    parser.add_argument('--checkpoint_dir', required=True)
+    parser.add_argument('--data_dir', required=True)
+    parser.add_argument('--output_size', type=int, required=True)
+    parser.add_argument('--pipeline_key', required=True, 
+                        help='utils.scorer.pipeline_key of the training input pipeline')
+    parser.add_argument('--lr_scheduler', type=int, default=1)
+    parser.add_argument('--parent_pid', type=int, default=None)
+    parser.add_argument('--poll_interval', type=float, default=1.)
+    parser.add_argument('--gpu_mem', type=float, default=0.,
+                        help='GPU memory fraction of the scoring model; 0 runs it on the CPU')
+    args = parser.parse_args()
+
+    if args.gpu_mem > 0:
+        config = tf.ConfigProto()
+        config.gpu_options.per_process_gpu_memory_fraction = args.gpu_mem
+    else:
+        config = tf.ConfigProto(device_count={'GPU': 0})
+    sc = scorer.Scorer(args.dataset, bool(args.lr_scheduler), session_config=config)
+    sc.load_three_sample(args.checkpoint_dir)
+    log = timer.Timer()
+
+    if not sc.load_train_codes(args.data_dir, args.output_size, args.pipeline_key):
+        print('[!] Codes not found. Waiting for train images...')
+        path = os.path.join(args.spool_dir, 'train_images.npy')
+        open(os.path.join(args.spool_dir, 'need_train_images'), 'w').close()
+        while not os.path.exists(path):
+            if (args.parent_pid is not None) and not parent_alive(args.parent_pid):
+                return
+            time.sleep(args.poll_interval)
+        sc.featurize_train_images(np.load(path).astype(np.float32) / 255.)
+        os.remove(path)
+
+    while True:
+        steps = spooled_steps(args.spool_dir)
+        if len(steps) == 0:
+            if (args.parent_pid is not None) and not parent_alive(args.parent_pid):
+                break
+            time.sleep(args.poll_interval)
+            continue
+        step = steps[0]
+        path = os.path.join(args.spool_dir, 'samples%d.npy' % step)
+        log(step, "Scoring start")
+        samples = np.load(path).astype(np.float32) / 255.
+        decision = sc.score(samples, step, args.sample_dir,
+                            args.checkpoint_dir, log)
+        scorer.save_atomic(os.path.join(args.spool_dir, 'decision%d.json' % step),
+                            lambda f, d: f.write(json.dumps(d).encode()), decision)
+        os.remove(path)
+        sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    main()
@@ -5,23 +5,63 @@ Created on Wed Jan 10 17:23:38 2018
 
 @author: mikolajbinkowski
 """
-import time, os, scipy, sys
+import time, os, scipy, sys, glob, json, subprocess
 import numpy as np
 from core import mmd
 import compute_scores as cs
 
+def schedule(dataset):
+    "Number of samples to score and scoring frequency in steps."
+    if dataset == 'mnist':
+        return 100000, 500
+    return 25000, 2000
+
+
+def draw_train_images(gan, size):
+    ims = []
+    while len(ims) < size // gan.batch_size:
+        ims.append(gan.sess.run(gan.images))
+    return np.concatenate(ims, axis=0)[:size]
+
+
+def inception_pixels(images):
+    # pipeline images are in [0, 1], Inception takes [0, 255]
+    return images * 255.
+
+
+def lenet_pixels(images):
+    # LeNet takes [-.5, .5], as in Scorer.score
+    return images - .5
+
+
+def pipeline_key(gan):
+    # identifies the input pipeline, and its preprocessing, train images come from
+    return cs.CodesCache.key(*gan.pipeline.preprocessing())
+
+
+def to_uint8(images, chunk=1000):
+    # [0, 1] floats -> [0, 255] uint8, a chunk at a time to avoid float temporaries
+    out = np.empty(images.shape, dtype=np.uint8)
+    for start in range(0, len(images), chunk):
+        out[start:start + chunk] = np.clip(images[start:start + chunk] * 255. + .5, 0, 255)
+    return out
+
+
+def save_atomic(path, save, *args, **kwargs):
+    # readers only ever see complete files
+    with open(path + '.tmp', 'wb') as f:
+        save(f, *args, **kwargs)
+    os.rename(path + '.tmp', path)
+
+
 class Scorer(object):
-    def __init__(self, dataset, lr_scheduler=True, stdout=sys.stdout):
+    def __init__(self, dataset, lr_scheduler=True, stdout=sys.stdout, session_config=None):
         self.stdout = stdout
         self.dataset = dataset
-        if dataset == 'mnist':
-            self.model = cs.LeNet()
-            self.size = 100000
-            self.frequency = 500
-        else:
-            self.model = cs.Inception()
-            self.size = 25000
-            self.frequency = 2000
+        self.size, self.frequency = schedule(dataset)
+        self.model = cs.load_model('lenet' if dataset == 'mnist' else 'inception',
+                                   config=session_config)
+        self.pixels = lenet_pixels if dataset == 'mnist' else inception_pixels
         
         self.output = []
 
@@ -30,23 +70,73 @@ class Scorer(object):
             self.three_sample_chances = 0
         self.lr_scheduler = lr_scheduler
             
+    three_sample_keys = ['Kt_YY_sums', 'Kt_YY_2_sum', 'K_XY_sums_0', 'K_XY_sums_1', 'K_XY_2_sum']
+
+    def save_three_sample(self, checkpoint_dir):
+        """
+        Stores the three-sample test history as stacked float32 arrays in
+        <checkpoint_dir>/three_sample.npz, oldest sample first.
+        """
+        if not self.lr_scheduler:
+            return
+        if not os.path.exists(checkpoint_dir):
+            os.makedirs(checkpoint_dir)
+        path = os.path.join(checkpoint_dir, 'three_sample.npz')
+        arrays = {'chances': np.int64(self.three_sample_chances)}
+        if len(self.three_sample) > 0:
+            stacked = mmd.np_stack_sums(self.three_sample)
+            arrays.update((k, v.astype(np.float32)) for k, v in zip(self.three_sample_keys, stacked))
+        save_atomic(path, np.savez, **arrays)
+
+    def load_three_sample(self, checkpoint_dir):
+        path = os.path.join(checkpoint_dir, 'three_sample.npz')
+        if (not self.lr_scheduler) or (not os.path.exists(path)):
+            return False
+        with np.load(path) as f:
+            self.three_sample_chances = int(f['chances'])
+            if self.three_sample_keys[0] in f:
+                stacked = [f[k] for k in self.three_sample_keys]
+                self.three_sample = [tuple(s[i] for s in stacked) for i in range(len(stacked[0]))]
+            else:
+                self.three_sample = []
+        print('[*] %d 3-sample test statistics loaded from <%s>' % (len(self.three_sample), path))
+        return True
+
+    def load_train_codes(self, data_dir, output_size, pipeline_key):
+        # train images are random draws from the input pipeline, so the codes
+        # are keyed by what they are drawn from rather than by content
+        self.cache = cs.CodesCache(os.path.join(data_dir, 'codes-cache'))
+        self.cache_key = self.cache.key(self.dataset, self.size, output_size, 
+                                        pipeline_key, self.model, self.pixels)
+        moments_path = os.path.join(self.cache.directory, '%s-moments.npz' % self.cache_key)
+        codes = self.cache.get(self.cache_key, 'codes')
+        if codes is None:
+            return False
+        self.train_codes = codes
+        if os.path.exists(moments_path):
+            self.train_moments = cs.CodeMoments.load(moments_path)
+        else:
+            self.train_moments = cs.CodeMoments.from_codes(codes)
+            self.train_moments.save(moments_path)
+        print('[*] Train codes loaded. ')
+        return True
+
+    def featurize_train_images(self, ims):
+        # call load_train_codes first, which sets the cache key
+        moments_path = os.path.join(self.cache.directory, '%s-moments.npz' % self.cache_key)
+        self.train_moments = cs.CodeMoments(self.model.coder_dim)
+        _, codes = cs.featurize(ims, self.model, transformer=self.pixels, get_preds=True, 
+                                get_codes=True, output=self.stdout,
+                                moments=self.train_moments)
+        self.train_codes = self.cache.put(self.cache_key, 'codes', codes)
+        self.train_moments.save(moments_path)
+        print('[*] %d train images featurized and saved in <%s>' % (self.size, self.cache.directory))
+
     def set_train_codes(self, gan):
-        suffix = '' if (gan.output_size <= 32) else ('-%d' % gan.output_size)
-        path = os.path.join(gan.data_dir, '%s-codes%s.npy' % (self.dataset, suffix))
-      
-        if os.path.exists(path):
-            self.train_codes = np.load(path)
-            print('[*] Train codes loaded. ')
+        if self.load_train_codes(gan.data_dir, gan.output_size, pipeline_key(gan)):
             return
         print('[!] Codes not found. Featurizing...')    
-        ims = []
-        while len(ims) < self.size // gan.batch_size:
-            ims.append(gan.sess.run(gan.images))
-        ims = np.concatenate(ims, axis=0)[:self.size]
-        _, self.train_codes = cs.featurize(ims * 255., self.model, get_preds=True, 
-                                           get_codes=True, output=self.stdout)
-        np.save(path, self.train_codes)
-        print('[*] %d train images featurized and saved in <%s>' % (self.size, path))
+        self.featurize_train_images(draw_train_images(gan, self.size))
                     
     def compute(self, gan, step):
         if step % self.frequency != 0:
@@ -56,10 +146,21 @@ class Scorer(object):
             print('[ ] Getting train codes...')
             self.set_train_codes(gan)
             
-        tt = time.time()
         gan.timer(step, "Scoring start")
-        output = {}
         images4score = gan.get_samples(n=self.size, save=False)
+        decision = self.score(images4score, step, gan.sample_dir, 
+                              gan.checkpoint_dir, gan.timer)
+        apply_decision(gan, decision)
+
+    def score(self, images4score, step, sample_dir, checkpoint_dir, timer):
+        """
+        Scores generated images with values in [0, 1], saves the scores in
+        <sample_dir>/score<step>.npz and returns the resulting decisions for
+        the training loop, see apply_decision.
+        """
+        tt = time.time()
+        output = {}
+        decision = {'step': step, 'save_best': False, 'decay_lr': False}
         if self.dataset == 'mnist': #LeNet model takes [-.5, .5] pics
             images4score -= .5
             if (images4score.max() > .5) or (images4score.min() < -.5):
@@ -73,30 +174,29 @@ class Scorer(object):
                 
         preds, codes = cs.featurize(images4score, self.model, get_preds=True, 
                                     get_codes=True, output=self.stdout)
-        gan.timer(step, "featurizing finished")
+        timer(step, "featurizing finished")
         
         output['inception'] = scores = cs.inception_score(preds)
-        gan.timer(step, "Inception mean (std): %f (%f)" % (np.mean(scores), np.std(scores)))
+        timer(step, "Inception mean (std): %f (%f)" % (np.mean(scores), np.std(scores)))
         
-        output['fid'] = scores = cs.fid_score(codes, self.train_codes, output=self.stdout, 
-                                              split_method='bootstrap',
+        output['fid'] = scores = cs.fid_score(codes, self.train_moments, output=self.stdout, 
+                                              split_method='bootstrap', sqrt_method='eigh',
                                               splits=3)
-        gan.timer(step, "FID mean (std): %f (%f)" % (np.mean(scores), np.std(scores)))
+        timer(step, "FID mean (std): %f (%f)" % (np.mean(scores), np.std(scores)))
         
         ret = cs.polynomial_mmd_averages(codes, self.train_codes, output=self.stdout, 
                                         n_subsets=10, subset_size=1000, 
                                         ret_var=False)
         output['mmd2'] = mmd2s = ret
-        gan.timer(step, "KID mean (std): %f (%f)" % (mmd2s.mean(), mmd2s.std()))           
+        timer(step, "KID mean (std): %f (%f)" % (mmd2s.mean(), mmd2s.std()))           
         
         if len(self.output) > 0:
             if np.min([sc['mmd2'].mean() for sc in self.output]) > output['mmd2'].mean():
-                print('Saving best model ...')
-                gan.save_checkpoint()
+                decision['save_best'] = True
         self.output.append(output)
                 
         
-        filepath = os.path.join(gan.sample_dir, 'score%d.npz' % step)
+        filepath = os.path.join(sample_dir, 'score%d.npz' % step)
         np.savez(filepath, **output)
 
         
@@ -110,34 +210,154 @@ class Scorer(object):
             X = self.train_codes[:bs]
             print('No. of copmuted 3-sample statics: %d' % len(self.three_sample))
             if len(self.three_sample) >= n:
-                saved_Z = self.three_sample[0]
-                mmd2_diff, test_stat, Y_related_sums = \
+                # the whole history is tested at once and logged; like before, the decision
+                # uses the oldest sample (about 20k steps back)
+                saved_Z = mmd.np_stack_sums(self.three_sample)
+                mmd2_diffs, test_stats, Y_related_sums = \
                     mmd.np_diff_polynomial_mmd2_and_ratio_with_saving(X, new_Y, saved_Z)
+                test_stat = test_stats[0]
                 p_val = scipy.stats.norm.cdf(test_stat)
-                gan.timer(step, "3-sample test stat = %.1f" % test_stat)
-                gan.timer(step, "3-sample p-value = %.1f" % p_val)
+                print('3-sample test stats against history (oldest first): ' + 
+                      ' '.join('%.1f' % t for t in test_stats))
+                timer(step, "3-sample test stat = %.1f" % test_stat)
+                timer(step, "3-sample p-value = %.1f" % p_val)
                 if p_val > .1:
                     self.three_sample_chances += 1
                     if self.three_sample_chances >= nc:
                         # no confidence that new Y sample is closer to X than old Z is
-                        gan.sess.run(gan.lr_decay_op)
-                        print('No improvement in last %d tests. Decreasing learning rate to %f' % \
-                              (nc, gan.sess.run(gan.lr)))
+                        decision['decay_lr'] = True
+                        print('No improvement in last %d tests. Decreasing learning rate.' % nc)
                         self.three_sample = (self.three_sample + [Y_related_sums])[-nc:] # reset memorized sums
                         self.three_sample_chances = 0
                     else:
-                        print('No improvement in last %d test(s). Keeping learning rate at %f' % \
-                              (self.three_sample_chances, gan.sess.run(gan.lr)))
+                        print('No improvement in last %d test(s). Keeping learning rate.' % \
+                              self.three_sample_chances)
                 else:
                     # we're confident that new_Y is better than old_Z is
-                    print('Keeping learning rate at %f' % gan.sess.run(gan.lr))
+                    print('Keeping learning rate.')
                     self.three_sample = self.three_sample[1:] + [Y_related_sums]
                     self.three_sample_chances = 0
             else: # add new sums to memory
                 self.three_sample.append(
                     mmd.np_diff_polynomial_mmd2_and_ratio_with_saving(X, new_Y, None)
                 )
-                gan.timer(step, "computing stats for 3-sample test finished")    
-                print('current learning rate: %f' % gan.sess.run(gan.lr))
+                timer(step, "computing stats for 3-sample test finished")    
+            self.save_three_sample(checkpoint_dir)
                 
-        gan.timer(step, "Scoring end, total time = %.1f s" % (time.time() - tt))
+        timer(step, "Scoring end, total time = %.1f s" % (time.time() - tt))
+        return decision
+
+
+def apply_decision(gan, decision, weights=None):
+    """
+    decision: as returned by Scorer.score
+    weights: prefix of the weights that were scored, if they are not the
+        current ones, see MMD_GAN.save_checkpoint
+    """
+    if decision['save_best']:
+        print('Saving best model ...')
+        gan.save_checkpoint(weights=weights)
+    if decision['decay_lr']:
+        gan.sess.run(gan.lr_decay_op)
+        print('Decreased learning rate to %f' % gan.sess.run(gan.lr))
+    elif hasattr(gan, 'lr'):
+        print('current learning rate: %f' % gan.sess.run(gan.lr))
+
+
+class AsyncScorer(object):
+    """
+    Runs the scoring of Scorer in a separate worker process, score_worker.py,
+    which shares no state with training except files in <sample_dir>/spool:
+        samples<step>.npy   generated images as uint8, written by training
+        weights-<step>.*    the weights that generated them, saved as the
+                            best model if the worker says so
+        decision<step>.json the worker's decisions, see Scorer.score
+        need_train_images   asks training for train_images.npy, written once
+                            if the train codes are not cached yet
+    Decisions are applied by training at the first step after they appear.
+    """
+    def __init__(self, dataset, lr_scheduler=True, stdout=sys.stdout):
+        self.stdout = stdout
+        self.dataset = dataset
+        self.size, self.frequency = schedule(dataset)
+        self.lr_scheduler = lr_scheduler
+        self.worker = None
+        self.pending = []
+
+    def load_three_sample(self, checkpoint_dir):
+        # the worker restores the 3-sample test history itself
+        return False
+
+    def start(self, gan):
+        self.spool_dir = os.path.join(gan.sample_dir, 'spool')
+        if not os.path.exists(self.spool_dir):
+            os.makedirs(self.spool_dir)
+        for name in os.listdir(self.spool_dir):  # leftovers of a previous worker
+            if name.startswith(('decision', 'samples', 'weights')):
+                os.remove(os.path.join(self.spool_dir, name))
+        worker = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 
+                              'score_worker.py')
+        self.worker = subprocess.Popen([
+            sys.executable, worker, 
+            '--dataset', self.dataset, 
+            '--spool_dir', self.spool_dir,
+            '--sample_dir', gan.sample_dir, 
+            '--checkpoint_dir', gan.checkpoint_dir, 
+            '--data_dir', gan.data_dir, 
+            '--output_size', str(gan.output_size),
+            '--pipeline_key', pipeline_key(gan),
+            '--lr_scheduler', str(int(bool(self.lr_scheduler))),
+            '--parent_pid', str(os.getpid()),
+            # the worker gets what training leaves of the GPU, or the CPU
+            '--gpu_mem', '%g' % max(.95 - gan.config.gpu_mem, 0.)
+        ], stdout=self.stdout, stderr=subprocess.STDOUT)
+        print('[*] Scoring worker started, pid %d' % self.worker.pid)
+
+    def poll(self, gan):
+        request = os.path.join(self.spool_dir, 'need_train_images')
+        if os.path.exists(request):
+            print('[ ] Drawing train images for the scoring worker...')
+            save_atomic(os.path.join(self.spool_dir, 'train_images.npy'), 
+                         np.save, to_uint8(draw_train_images(gan, self.size)))
+            os.remove(request)
+        for step in list(self.pending):
+            path = os.path.join(self.spool_dir, 'decision%d.json' % step)
+            if os.path.exists(path):
+                with open(path) as f:
+                    decision = json.load(f)
+                os.remove(path)
+                self.pending.remove(step)
+                print('[*] Scores of step %d received.' % step)
+                apply_decision(gan, decision, weights=self._weights(step))
+                self._remove_weights(step)
+        if (self.worker.poll() is not None) and (len(self.pending) > 0):
+            print('WARNING! Scoring worker exited with code %d, %d scorings lost.' % \
+                  (self.worker.returncode, len(self.pending)))
+            for step in self.pending:
+                self._remove_weights(step)
+            self.pending = []
+
+    def _weights(self, step):
+        return os.path.join(self.spool_dir, 'weights-%d' % step)
+
+    def _remove_weights(self, step):
+        for f in glob.glob(self._weights(step) + '.*'):
+            os.remove(f)
+
+    def compute(self, gan, step):
+        if self.worker is not None:
+            self.poll(gan)
+        if step % self.frequency != 0:
+            return
+        if (self.worker is None) or (self.worker.poll() is not None):
+            self.start(gan)
+        gan.timer(step, "Spooling samples for scoring")
+        samples = gan.get_samples(n=self.size, save=False)
+        # keep the scored weights until the decision arrives; write_state=False
+        # leaves the checkpoint index and the rotation of checkpoints alone
+        gan.saver.save(gan.sess, os.path.join(self.spool_dir, 'weights'), 
+                       global_step=step, write_state=False, write_meta_graph=False)
+        # uint8 samples are a quarter of the size, at the precision of real images
+        save_atomic(os.path.join(self.spool_dir, 'samples%d.npy' % step), 
+                    np.save, to_uint8(samples))
+        self.pending.append(step)